@@ -0,0 +1,111 @@
+import threading
+from collections import deque
+from typing import Callable, List
+
+from telegram.utils.promise import Promise
+
+import log
+
+logger = log.get_logger(__name__)
+
+
+class BroadcastAdmission:
+    """Limits the number of broadcasts that are sent at the same time and the number of their queued messages.
+
+    Broadcasts above max_concurrent wait in a FIFO queue. The message budget (max_queued_messages) is split evenly
+    between the running broadcasts, so their messages are interleaved in the message queue of the bot and every
+    broadcast gets the same share of the rate limit. bot_name is added to the log records of failed broadcasts.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued_messages: int, bot_name: str = ''):
+        self.max_concurrent = max_concurrent
+        self.max_queued_messages = max_queued_messages
+        self.bot_name = bot_name
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = deque()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def share(self) -> int:
+        """Number of messages a single running broadcast may have in the message queue."""
+        return max(1, self.max_queued_messages // max(1, self._running))
+
+    def submit(self, func: Callable, *args, on_error: Callable[[Exception], None] = None) -> int:
+        """Runs func(window, *args) in a background thread as soon as the limit allows it. If it raises an exception,
+        on_error is called with it (e.g., to inform the sender).
+
+        Returns 0 if the broadcast was started immediately, otherwise its position in the waiting queue.
+        """
+        with self._lock:
+            if self._running >= self.max_concurrent:
+                self._waiting.append((func, args, on_error))
+                return len(self._waiting)
+            self._running += 1
+        self._start(func, args, on_error)
+        return 0
+
+    def _start(self, func, args, on_error):
+        threading.Thread(target=self._run, args=(func, args, on_error), name='broadcast', daemon=True).start()
+
+    def _run(self, func, args, on_error):
+        try:
+            func(SendWindow(self), *args)
+        except Exception as e:
+            logger.exception("Broadcast failed", extra={'bot': self.bot_name})
+            if on_error is not None:
+                try:
+                    on_error(e)
+                except Exception:
+                    logger.exception("Reporting the failed broadcast failed", extra={'bot': self.bot_name})
+        finally:
+            with self._lock:
+                if len(self._waiting) > 0:
+                    # The slot is handed over to the next broadcast
+                    next_broadcast = self._waiting.popleft()
+                else:
+                    self._running -= 1
+                    next_broadcast = None
+            if next_broadcast is not None:
+                self._start(*next_broadcast)
+
+
+class SendWindow:
+    """Keeps the unfinished promises of one broadcast within its share of the message budget.
+
+    add() blocks until the oldest recipients are done if the share is used up. on_done is called with the key and the
+    finished promises of every recipient in the order they were added (failed promises included, see
+    Promise.exception).
+    """
+
+    def __init__(self, admission: BroadcastAdmission):
+        self.admission = admission
+        self.on_done = None
+        self._pending = deque()
+        self._pending_promises = 0
+
+    def add(self, key, promises: List[Promise]):
+        self._pending.append((key, promises))
+        self._pending_promises += len(promises)
+        while self._pending_promises >= self.admission.share():
+            self._complete_oldest()
+
+    def finish(self):
+        """Waits until all promises are done."""
+        while len(self._pending) > 0:
+            self._complete_oldest()
+
+    def _complete_oldest(self):
+        key, promises = self._pending.popleft()
+        for promise in promises:
+            # result() would raise the exception of a failed send; a failed recipient must not stop the broadcast
+            promise.done.wait()
+        self._pending_promises -= len(promises)
+        if self.on_done is not None:
+            self.on_done(key, promises)
@@ -0,0 +1,119 @@
+"""Planning of broadcasts: which Bot API calls are needed and how long the message queue needs to deliver them.
+
+The functions in this module do not send anything, so they can be used for a dry run before a broadcast as well as
+for capacity planning, e.g.:
+
+    calls = count_api_calls(messages)
+    seconds = simulate_message_queue(10000 * sum(calls.values()))
+"""
+from collections import Counter
+from typing import List, Iterable
+
+from telegram import Message
+
+from db import MyDatabaseSession, Channel
+
+# Limits for the message queue (recommended values for production: 29/1017)
+MQ_ALL_BURST_LIMIT = 29
+MQ_ALL_TIME_LIMIT_MS = 1017
+
+# Telegram allows between 2 and 10 items in an album
+MAX_ALBUM_SIZE = 10
+
+
+class DryRunResult:
+    recipients = 0
+    # Calls needed for every single recipient by Bot API method
+    calls_per_recipient = None  # type: Counter
+    total_calls = 0
+    estimated_seconds = 0.0
+
+    def calls_by_method(self) -> Counter:
+        return Counter({method: count * self.recipients for method, count in self.calls_per_recipient.items()})
+
+
+def group_messages(messages: Iterable[Message]) -> List[List[Message]]:
+    """Splits the messages into the units they are sent as: consecutive messages of the same album are grouped."""
+    units = []
+    for message in messages:
+        if units and message.media_group_id is not None and len(units[-1]) < MAX_ALBUM_SIZE \
+                and units[-1][-1].media_group_id == message.media_group_id \
+                and (message.photo or message.video) and (units[-1][-1].photo or units[-1][-1].video):
+            units[-1].append(message)
+        else:
+            units.append([message])
+    return units
+
+
+def api_method(unit: List[Message]):
+    """Bot API method used to send a unit returned by group_messages() (None if the message type is not supported)."""
+    if len(unit) > 1:
+        return 'sendMediaGroup'
+    message = unit[0]
+    if message.text:
+        return 'sendMessage'
+    elif message.photo:
+        return 'sendPhoto'
+    elif message.sticker:
+        return 'sendSticker'
+    elif message.video:
+        return 'sendVideo'
+    return None
+
+
+def count_api_calls(messages: Iterable[Message]) -> Counter:
+    """Number of calls by Bot API method that are needed to send the messages to a single recipient."""
+    calls = Counter()
+    for unit in group_messages(messages):
+        method = api_method(unit)
+        if method is not None:
+            calls[method] += 1
+    return calls
+
+
+def simulate_message_queue(call_count: int,
+                           burst_limit: int = MQ_ALL_BURST_LIMIT,
+                           time_limit_ms: int = MQ_ALL_TIME_LIMIT_MS,
+                           call_duration_ms: float = 0) -> float:
+    """Estimated time in seconds until the message queue has processed the given number of calls.
+
+    This replays the delay routine of telegram.ext.messagequeue.DelayQueue on a simulated clock. call_duration_ms can
+    be used to account for the time a single request to the Bot API takes.
+    """
+    # The simulated clock counts integer microseconds to avoid rounding errors in the comparisons below
+    time_limit = int(time_limit_ms * 1000)
+    call_duration = int(call_duration_ms * 1000)
+    clock = 0
+    times = []
+    for _ in range(call_count):
+        now = clock
+        t_delta = now - time_limit
+        # On a real clock, time.sleep() always overshoots slightly, so the comparison in DelayQueue is always true
+        # directly after a delay. The simulated clock is exact, so we need to include equality.
+        if times and t_delta >= times[-1]:
+            times = [now]
+        else:
+            times = [t for t in times if t >= t_delta]
+            times.append(now)
+        if len(times) >= burst_limit:
+            clock += times[1] - t_delta
+        clock += call_duration
+    return clock / 1000000
+
+
+def dry_run(session: MyDatabaseSession, channels: List[Channel], messages: List[Message],
+            burst_limit: int = MQ_ALL_BURST_LIMIT,
+            time_limit_ms: int = MQ_ALL_TIME_LIMIT_MS,
+            call_duration_ms: float = 0) -> DryRunResult:
+    """Resolves the recipients of a broadcast and estimates its cost without sending anything."""
+    result = DryRunResult()
+    if len(channels) == 1:
+        result.recipients = channels[0].subscriber_count
+    else:
+        # Users subscribed to several of the channels receive the messages only once
+        result.recipients = session.count_subscribers([channel.id for channel in channels])
+    result.calls_per_recipient = count_api_calls(messages)
+    result.total_calls = result.recipients * sum(result.calls_per_recipient.values())
+    result.estimated_seconds = simulate_message_queue(result.total_calls, burst_limit, time_limit_ms,
+                                                      call_duration_ms)
+    return result
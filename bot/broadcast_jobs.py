@@ -0,0 +1,176 @@
+import threading
+from typing import List
+
+from telegram import ParseMode
+from telegram.utils.promise import Promise
+
+import db
+import log
+from db import my_session_scope
+
+logger = log.get_logger(__name__)
+
+JOB_EDIT = 'edit'
+JOB_DELETE = 'delete'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+# Message types whose text (or caption) can be edited
+EDITABLE_TYPES = ('text', 'photo', 'video')
+
+
+def failed(promise: Promise) -> bool:
+    """Waits until the request of the promise is done and returns whether it failed."""
+    # result() would raise the exception of the request
+    promise.done.wait()
+    return promise.exception is not None or promise.result() is None
+
+
+class BroadcastJobs:
+    """Stores the message ids of sent broadcasts and edits or deletes those messages again.
+
+    Edit and delete jobs run in a background thread each. All calls go through the message queue of the bot, so they
+    share its rate limit with all other messages. The progress is stored in the database after each batch, so that
+    jobs interrupted by a restart are continued by resume().
+    """
+
+    def __init__(self, my_database: db.MyDatabase, bot, batch_size: int = 200):
+        self.my_database = my_database
+        self.bot = bot
+        self.batch_size = batch_size
+
+    def recorder(self, broadcast_id: int, unit_sizes: List[int]) -> 'RecipientRecorder':
+        """Returns a recorder that stores the message ids of the broadcast in batches."""
+        return RecipientRecorder(self.my_database, broadcast_id, unit_sizes, self.batch_size)
+
+    def start(self, broadcast_id: int, job: str, notify_chat_id, text: str = None):
+        with my_session_scope(self.my_database) as session:  # type: db.MyDatabaseSession
+            broadcast = session.get_broadcast(broadcast_id)
+            broadcast.job = job
+            broadcast.job_state = STATE_RUNNING
+            broadcast.job_text = text
+            broadcast.job_chat_id = notify_chat_id
+            broadcast.job_position = None
+            broadcast.job_failures = 0
+        self._spawn(broadcast_id)
+
+    def resume(self):
+        with my_session_scope(self.my_database) as session:  # type: db.MyDatabaseSession
+            # Sending is not continued after a restart, the recipients recorded so far can be edited or deleted
+            interrupted = session.finish_interrupted_broadcast_sending()
+            if interrupted > 0:
+                logger.warning("Sending of {0} broadcasts was interrupted".format(interrupted))
+            broadcast_ids = [broadcast.id for broadcast in session.get_running_broadcast_jobs()]
+        for broadcast_id in broadcast_ids:
+            logger.info("Resuming job for broadcast {0}".format(broadcast_id))
+            self._spawn(broadcast_id)
+
+    def _spawn(self, broadcast_id):
+        threading.Thread(target=self._run, args=(broadcast_id,),
+                         name='broadcast_job_{0}'.format(broadcast_id), daemon=True).start()
+
+    def _run(self, broadcast_id):
+        try:
+            while self._run_batch(broadcast_id):
+                pass
+        except Exception:
+            logger.exception("Job for broadcast {0} failed".format(broadcast_id))
+        finally:
+            # A job left running would block further edits or recalls of the broadcast and be repeated on each restart
+            self._finish_failed(broadcast_id)
+
+    def _finish_failed(self, broadcast_id):
+        try:
+            with my_session_scope(self.my_database) as session:  # type: db.MyDatabaseSession
+                broadcast = session.get_broadcast(broadcast_id)
+                if broadcast.job_state == STATE_RUNNING:
+                    broadcast.job_state = STATE_FAILED
+                    self._notify(broadcast)
+        except Exception:
+            logger.exception("Marking the job for broadcast {0} as failed failed".format(broadcast_id))
+
+    def _run_batch(self, broadcast_id) -> bool:
+        with my_session_scope(self.my_database) as session:  # type: db.MyDatabaseSession
+            broadcast = session.get_broadcast(broadcast_id)
+            if broadcast.job_state != STATE_RUNNING:
+                return False
+            recipients = session.get_broadcast_recipients(broadcast_id, broadcast.job_position, self.batch_size)
+            if len(recipients) == 0:
+                broadcast.job_state = STATE_DONE
+                self._notify(broadcast)
+                return False
+            message_types = broadcast.message_types.split(",")
+            promises = []
+            for recipient in recipients:
+                message_ids = [int(message_id) for message_id in recipient.message_ids.split(",")]
+                promises.extend(self._process(broadcast, message_types, recipient.chat_id, message_ids))
+            # Wait until the batch is processed before storing the progress
+            broadcast.job_failures += sum(1 for promise in promises if failed(promise))
+            broadcast.job_position = recipients[-1].chat_id
+            return True
+
+    def _process(self, broadcast: db.Broadcast, message_types, chat_id, message_ids) -> List[Promise]:
+        if broadcast.job == JOB_DELETE:
+            return [self.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                    for message_id in message_ids if message_id != 0]
+        # Editing changes the text (or caption) of the first message
+        message_id = message_ids[0]
+        if message_id == 0:
+            return []
+        if message_types[0] == 'text':
+            return [self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=broadcast.job_text,
+                                               parse_mode=ParseMode.HTML)]
+        return [self.bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=broadcast.job_text,
+                                              parse_mode=ParseMode.HTML)]
+
+    def _notify(self, broadcast: db.Broadcast):
+        if broadcast.job_state == STATE_FAILED:
+            answer = "Beim Ändern der Nachrichten von Versand {0} ist ein Fehler aufgetreten, die Änderung wurde " \
+                     "abgebrochen. Sie kann erneut gestartet werden."
+        elif broadcast.job == JOB_DELETE:
+            answer = "Die Nachrichten von Versand {0} wurden gelöscht."
+        else:
+            answer = "Die Nachrichten von Versand {0} wurden bearbeitet."
+        if broadcast.job_failures > 0:
+            answer += " {1} Nachrichten konnten nicht geändert werden."
+        if broadcast.job_chat_id is not None:
+            self.bot.send_message(chat_id=broadcast.job_chat_id,
+                                  text=answer.format(broadcast.id, broadcast.job_failures))
+
+
+class RecipientRecorder:
+    """Collects the message ids of the recipients of a broadcast and stores them in batches.
+
+    unit_sizes contains the number of messages sent by each promise (albums consist of several messages).
+    """
+
+    def __init__(self, my_database: db.MyDatabase, broadcast_id: int, unit_sizes: List[int], batch_size: int):
+        self.my_database = my_database
+        self.broadcast_id = broadcast_id
+        self.unit_sizes = unit_sizes
+        self.batch_size = batch_size
+        self.failures = 0
+        self._batch = []
+
+    def add(self, chat_id, promises: List[Promise]):
+        """Adds a recipient whose promises are done."""
+        message_ids = []
+        for size, promise in zip(self.unit_sizes, promises):
+            if failed(promise):
+                self.failures += size
+                message_ids.extend([0] * size)
+                continue
+            result = promise.result()
+            if isinstance(result, list):
+                message_ids.extend(message.message_id for message in result)
+            else:
+                message_ids.append(result.message_id)
+        self._batch.append((chat_id, message_ids))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with my_session_scope(self.my_database) as session:  # type: db.MyDatabaseSession
+            session.add_broadcast_recipients(self.broadcast_id, self._batch)
+        self._batch = []
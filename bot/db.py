@@ -1,22 +1,37 @@
+import copy
 import time
 from contextlib import contextmanager
 from typing import List
 
-from sqlalchemy import Table, Column, Integer, String, Boolean, ForeignKey, event, create_engine
+from sqlalchemy import Table, Column, Integer, String, Text, Boolean, ForeignKey, Index, UniqueConstraint, MetaData, \
+    event, create_engine, inspect, func, select, distinct, exists, literal, and_
+from sqlalchemy.schema import AddConstraint, DropConstraint
 import sqlalchemy.engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.orm import sessionmaker, relationship, Session, joinedload
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.collections import attribute_mapped_collection
 
 from sqlite3 import Connection as SQLite3Connection
 
+from readiness import LazyInitializer
+
 Base = declarative_base()
 
 user_channels = Table('user_channels', Base.metadata,
                       Column('chat_id', ForeignKey('users.chat_id', ondelete='CASCADE'), primary_key=True),
-                      Column('channel_id', ForeignKey('channels.id', ondelete='CASCADE'), primary_key=True)
+                      Column('channel_id', ForeignKey('channels.id', ondelete='CASCADE'), primary_key=True),
+                      # The primary key index cannot be used to find the subscribers of a channel
+                      Index('ix_user_channels_channel_id', 'channel_id')
                       )
 
+# Users that started the bot with the given name. Several bots can be served by one process (see tenants.py), they
+# share the users table, but every bot only sees its own users and channels.
+bot_users = Table('bot_users', Base.metadata,
+                  Column('bot', String(64), primary_key=True),
+                  Column('chat_id', ForeignKey('users.chat_id', ondelete='CASCADE'), primary_key=True)
+                  )
+
 
 def case_insensitive_string(length):
     return String(length).with_variant(String(length, collation='utf8_general_ci'), 'mysql')\
@@ -34,8 +49,9 @@ class User(Base):
     ldap_account = Column(String(1024))
     ldap_register_token = Column(String(25))
 
+    # Subscribed channels of all bots by channel id
     channels = relationship('Channel',
-                            collection_class=attribute_mapped_collection('name'),
+                            collection_class=attribute_mapped_collection('id'),
                             secondary=user_channels,
                             back_populates='users',
                             cascade='all, delete')  # type: dict
@@ -59,12 +75,17 @@ class User(Base):
 
 class Channel(Base):
     __tablename__ = "channels"
+    __table_args__ = (UniqueConstraint('bot', 'name', name='uq_channels_bot_name'),)
     id = Column(Integer, primary_key=True)
-    name = Column(case_insensitive_string(255), unique=True, nullable=False)
+    name = Column(case_insensitive_string(255), nullable=False)
     description = Column(String(1024))
     default = Column(Boolean, default=False, nullable=False)
     mandatory = Column(Boolean, default=False, nullable=False)
     ldap_filter = Column(String(1024), nullable=False)
+    # Name of the bot the channel belongs to ('' for the main bot). Every bot has its own channel names.
+    bot = Column(String(64), default='', server_default='', nullable=False)
+    # Maintained incrementally by MyDatabaseSession, can be rebuilt with reconcile_subscriber_counts()
+    subscriber_count = Column(Integer, default=0, server_default='0', nullable=False)
 
     users = relationship('User',
                          secondary=user_channels,
@@ -72,14 +93,116 @@ class Channel(Base):
                          cascade='all, delete')
 
 
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+    id = Column(Integer, primary_key=True)
+    sender_chat_id = Column(Integer, nullable=False, index=True)
+    bot = Column(String(64), default='', server_default='', nullable=False)
+    time_sent = Column(Integer, nullable=False)
+    channels = Column(String(1024), nullable=False)
+    # Comma-separated types of the sent messages (see BroadcastRecipient.message_ids)
+    message_types = Column(String(255), nullable=False)
+    # Set when all messages were sent (or the sending was interrupted). Before that, only part of the recipients is
+    # recorded, so the broadcast cannot be edited or deleted yet.
+    sending_done = Column(Boolean, default=False, nullable=False)
+    # Running or finished bulk job on the sent messages ('edit' or 'delete')
+    job = Column(String(10))
+    job_state = Column(String(10))
+    job_text = Column(Text)
+    job_chat_id = Column(Integer)
+    # Recipients are processed ordered by chat_id, so the job can be resumed after the last processed chat_id
+    job_position = Column(Integer)
+    job_failures = Column(Integer, default=0, nullable=False)
+
+    def __init__(self, sender_chat_id, channels, message_types):
+        self.sender_chat_id = sender_chat_id
+        self.channels = channels
+        self.message_types = message_types
+        self.time_sent = int(time.time())
+        self.sending_done = False
+        self.job_failures = 0
+
+
+class BroadcastRecipient(Base):
+    __tablename__ = "broadcast_recipients"
+    broadcast_id = Column(Integer, ForeignKey('broadcasts.id', ondelete='CASCADE'), primary_key=True)
+    chat_id = Column(Integer, primary_key=True, autoincrement=False)
+    # Comma-separated message ids in the order of Broadcast.message_types (0 if sending failed)
+    message_ids = Column(String(1024), nullable=False)
+
+
+class UserPermission(Base):
+    """Snapshot of the LDAP permissions of a user, written by permissions.PermissionSync."""
+    __tablename__ = "user_permissions"
+    chat_id = Column(Integer, ForeignKey('users.chat_id', ondelete='CASCADE'), primary_key=True, autoincrement=False)
+    # The snapshot is only valid as long as the user is still connected to this account
+    ldap_account = Column(String(1024), nullable=False)
+    admin = Column(Boolean, nullable=False)
+    # Comma-separated ids of the channels the user may write to
+    channel_ids = Column(Text, nullable=False)
+    time_synced = Column(Integer, nullable=False)
+
+    def get_channel_ids(self) -> set:
+        return set(int(channel_id) for channel_id in self.channel_ids.split(",") if channel_id != "")
+
+
+class RoutingSession(Session):
+    """Session that sends queries to the read replica (if configured) while use_replica is set.
+
+    As soon as something was written in the session, all queries go to the primary database again, so that the
+    session always reads its own writes.
+    """
+
+    def __init__(self, replica_bind=None, **kwargs):
+        super().__init__(**kwargs)
+        self.replica_bind = replica_bind
+        self.use_replica = False
+        self.has_written = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica_bind is not None and self.use_replica and not self.has_written and not self._flushing:
+            return self.replica_bind
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, _flush_context):
+    session.has_written = True
+
+
+@event.listens_for(RoutingSession, 'after_bulk_update')
+@event.listens_for(RoutingSession, 'after_bulk_delete')
+def _after_bulk_write(context):
+    context.session.has_written = True
+
+
 class MyDatabaseSession:
     session = None
 
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, bot: str = None):
         self.session = session
+        # Users, channels and broadcasts are restricted to this bot (None: all bots, e.g., for the webinterface)
+        self.bot = bot
+        # A session is used for the handling of a single update. Users (loaded together with their channels) and the
+        # channel catalog are cached for its duration, so that all helpers share them instead of querying again.
+        self._users = {}
+        self._channels = None
+
+    @contextmanager
+    def _replica(self):
+        """Sends the queries in this block to the read replica (only used for reads that may be slightly outdated)."""
+        previous = self.session.use_replica
+        self.session.use_replica = True
+        try:
+            yield
+        finally:
+            self.session.use_replica = previous
 
     def commit(self):
         self.session.commit()
+        # All loaded objects are expired by the commit, so they are loaded again on the next access
+        self._users = {}
+        self._channels = None
 
     def close(self):
         self.session.close()
@@ -87,66 +210,423 @@ class MyDatabaseSession:
     def rollback(self):
         self.session.rollback()
 
+    def _query_channels(self):
+        query = self.session.query(Channel)
+        if self.bot is not None:
+            query = query.filter(Channel.bot == self.bot)
+        return query
+
+    def _query_users(self, *entities):
+        query = self.session.query(*entities)
+        if self.bot is not None:
+            query = query.filter(exists().where(and_(bot_users.columns['chat_id'] == User.chat_id,
+                                                     bot_users.columns['bot'] == self.bot)))
+        return query
+
     def get_user_by_chat_id(self, chat_id) -> User:
-        return self.session.query(User).filter(User.chat_id == chat_id).first()
+        if chat_id not in self._users:
+            self._users[chat_id] = self._query_users(User).options(joinedload(User.channels))\
+                .filter(User.chat_id == chat_id).one_or_none()
+        return self._users[chat_id]
+
+    def get_subscribed_channels(self, user: User) -> List[Channel]:
+        """Channels of this bot the user subscribed (user.channels contains the channels of all bots)."""
+        return [channel for channel in user.channels.values() if self.bot is None or channel.bot == self.bot]
+
+    def _invalidate_user(self, chat_id):
+        self._users.pop(chat_id, None)
 
     def get_users(self):
-        return self.session.query(User).all()
+        with self._replica():
+            return self._query_users(User).all()
+
+    def count_users(self) -> int:
+        with self._replica():
+            return self._query_users(func.count(User.chat_id)).scalar()
 
     def add_user(self, chat_id, username, first_name, last_name):
         if self.get_user_by_chat_id(chat_id) is None:
-            user = User(chat_id, username, first_name, last_name)
+            # The user may already be known from another bot
+            user = self.session.query(User).get(chat_id)
+            if user is None:
+                user = User(chat_id, username, first_name, last_name)
+                self.session.add(user)
+                self.session.flush()
+            if self.bot is not None:
+                self.session.execute(bot_users.insert().values(bot=self.bot, chat_id=chat_id))
             # Add user to default channels
-            for channel in self.session.query(Channel).filter(Channel.default.is_(True)).all():
-                user.channels[channel.name] = channel
-            self.session.add(user)
+            default_channels = [channel for channel in self._query_channels().filter(Channel.default.is_(True))
+                                if channel.id not in user.channels]
+            for channel in default_channels:
+                user.channels[channel.id] = channel
+            self._invalidate_user(chat_id)
+            self._change_subscriber_count([channel.id for channel in default_channels], 1)
 
     def delete_user(self, chat_id):
-        self.session.query(User).filter(User.chat_id == chat_id).delete()
+        self._invalidate_user(chat_id)
+        if self.bot is not None:
+            membership = and_(bot_users.columns['bot'] == self.bot, bot_users.columns['chat_id'] == chat_id)
+            if self.session.execute(bot_users.delete().where(membership)).rowcount == 0:
+                return
+            if self.session.query(bot_users).filter(bot_users.columns['chat_id'] == chat_id).count() > 0:
+                # The user still uses other bots, only the subscriptions of this bot are removed
+                channel_ids = [row[0] for row in self.session.query(user_channels.columns['channel_id'])
+                               .join(Channel, Channel.id == user_channels.columns['channel_id'])
+                               .filter(user_channels.columns['chat_id'] == chat_id, Channel.bot == self.bot)]
+                if len(channel_ids) > 0:
+                    self.session.execute(user_channels.delete()
+                                         .where(and_(user_channels.columns['chat_id'] == chat_id,
+                                                     user_channels.columns['channel_id'].in_(channel_ids))))
+                    self._change_subscriber_count(channel_ids, -1)
+                self.session.expire_all()
+                return
+        subscribed_channel_ids = [row[0] for row in
+                                  self.session.query(user_channels.columns['channel_id'])
+                                  .filter(user_channels.columns['chat_id'] == chat_id).all()]
+        self._invalidate_user(chat_id)
+        if self.session.query(User).filter(User.chat_id == chat_id).delete() > 0:
+            self._change_subscriber_count(subscribed_channel_ids, -1)
 
     def add_channel(self, chat_id, channel: Channel):
-        user = self.session.query(User).filter(User.chat_id == chat_id).one()
-        user.channels[channel.name] = channel
+        user = self._get_existing_user(chat_id)
+        if channel.id not in user.channels:
+            user.channels[channel.id] = channel
+            self._change_subscriber_count([channel.id], 1)
 
     def remove_channel(self, chat_id, channel: Channel):
-        user = self.session.query(User).filter(User.chat_id == chat_id).one()
-        del user.channels[channel.name]
+        user = self._get_existing_user(chat_id)
+        if channel.id in user.channels:
+            del user.channels[channel.id]
+            self._change_subscriber_count([channel.id], -1)
+
+    def _change_subscriber_count(self, channel_ids: List[int], delta: int):
+        if len(channel_ids) == 0:
+            return
+        # Update in the database instead of in Python, so that concurrent changes are not lost
+        self.session.query(Channel).filter(Channel.id.in_(channel_ids))\
+            .update({Channel.subscriber_count: Channel.subscriber_count + delta}, synchronize_session=False)
+        # Objects already loaded into the session still hold the old values (the primary key is taken from the identity
+        # key, as accessing obj.id could load an expired object)
+        for key, obj in list(self.session.identity_map.items()):
+            if isinstance(obj, Channel) and key[1][0] in channel_ids:
+                self.session.expire(obj, ['subscriber_count'])
+
+    def reconcile_subscriber_counts(self) -> int:
+        """Recalculate all subscriber counters from user_channels (e.g., after manual changes in the database) and
+        return the number of channels whose counter was wrong."""
+        count_query = select([func.count()]).select_from(user_channels)\
+            .where(user_channels.columns['channel_id'] == Channel.id).as_scalar()
+        corrected = self.session.query(Channel).filter(Channel.subscriber_count != count_query)\
+            .update({Channel.subscriber_count: count_query}, synchronize_session=False)
+        self.session.expire_all()
+        return corrected
+
+    # The following methods are used by maintenance.py, every call is meant to be one short transaction
+    def get_chat_id_batch_end(self, after_chat_id, batch_size: int):
+        """Largest chat id of the next batch of users after after_chat_id (None: from the start), None if no users
+        are left."""
+        query = self.session.query(User.chat_id)
+        if after_chat_id is not None:
+            query = query.filter(User.chat_id > after_chat_id)
+        batch_end = query.order_by(User.chat_id).offset(batch_size - 1).limit(1).scalar()
+        if batch_end is None:
+            # The last batch is smaller
+            batch_end = query.with_entities(func.max(User.chat_id)).scalar()
+        return batch_end
+
+    def add_missing_subscriptions(self, channel_id: int, after_chat_id, batch_end) -> int:
+        """Subscribes the channel for all users in the chat id range that do not have it yet (a single
+        INSERT ... SELECT) and returns the number of added subscriptions."""
+        condition = and_(User.chat_id <= batch_end,
+                         ~exists().where(and_(user_channels.columns['chat_id'] == User.chat_id,
+                                              user_channels.columns['channel_id'] == channel_id)))
+        if after_chat_id is not None:
+            condition = and_(User.chat_id > after_chat_id, condition)
+        if self.bot is not None:
+            condition = and_(condition, exists().where(and_(bot_users.columns['chat_id'] == User.chat_id,
+                                                            bot_users.columns['bot'] == self.bot)))
+        missing = select([User.chat_id, literal(channel_id)]).where(condition)
+        result = self.session.execute(user_channels.insert().from_select(['chat_id', 'channel_id'], missing))
+        self._change_subscriber_count([channel_id], result.rowcount)
+        return result.rowcount
+
+    def remove_orphaned_subscriptions(self, batch_size: int) -> int:
+        """Deletes up to batch_size users/channels worth of subscriptions whose user or channel does not exist
+        anymore (e.g., after manual changes in databases without enforced foreign keys) and returns the number of
+        deleted rows."""
+        chat_id_column = user_channels.columns['chat_id']
+        channel_id_column = user_channels.columns['channel_id']
+        deleted = 0
+        orphaned_chat_ids = [row[0] for row in self.session.query(chat_id_column)
+                             .filter(~exists().where(User.chat_id == chat_id_column)).distinct().limit(batch_size)]
+        if len(orphaned_chat_ids) > 0:
+            # The counters of the (existing) channels include the orphaned subscriptions
+            counts = self.session.query(channel_id_column, func.count())\
+                .filter(chat_id_column.in_(orphaned_chat_ids)).group_by(channel_id_column).all()
+            for channel_id, count in counts:
+                self._change_subscriber_count([channel_id], -count)
+            deleted += self.session.execute(user_channels.delete().where(chat_id_column.in_(orphaned_chat_ids)))\
+                .rowcount
+        orphaned_channel_ids = [row[0] for row in self.session.query(channel_id_column)
+                                .filter(~exists().where(Channel.id == channel_id_column)).distinct().limit(batch_size)]
+        if len(orphaned_channel_ids) > 0:
+            deleted += self.session.execute(user_channels.delete()
+                                            .where(channel_id_column.in_(orphaned_channel_ids))).rowcount
+        return deleted
 
     def remove_ldap(self, chat_id):
-        user = self.session.query(User).filter(User.chat_id == chat_id).one()
+        user = self._get_existing_user(chat_id)
         user.ldap_account = None
+        self.session.query(UserPermission).filter(UserPermission.chat_id == chat_id)\
+            .delete(synchronize_session=False)
+
+    def get_ldap_accounts(self) -> List[tuple]:
+        """(chat_id, ldap_account) of all users connected to an LDAP account."""
+        return self.session.query(User.chat_id, User.ldap_account).filter(User.ldap_account.isnot(None)).all()
+
+    def get_permission(self, chat_id) -> UserPermission:
+        return self.session.query(UserPermission).get(chat_id)
+
+    def set_permission(self, chat_id, ldap_account: str, admin: bool, channel_ids: List[int]) -> UserPermission:
+        return self.session.merge(UserPermission(chat_id=chat_id, ldap_account=ldap_account, admin=admin,
+                                                 channel_ids=",".join(map(str, sorted(channel_ids))),
+                                                 time_synced=int(time.time())))
+
+    def _get_existing_user(self, chat_id) -> User:
+        user = self.get_user_by_chat_id(chat_id)
+        if user is None:
+            raise NoResultFound("No user with chat_id {0}".format(chat_id))
+        return user
 
     def get_channel_by_name(self, name: str):
-        return self.session.query(Channel).filter(Channel.name == name).first()
+        if self._channels is None:
+            return self._query_channels().filter(Channel.name == name).first()
+        # Channel names are case-insensitive (see case_insensitive_string)
+        return next((channel for channel in self._channels if channel.name.lower() == name.lower()), None)
 
     def get_channel_by_id(self, channel_id: int):
-        return self.session.query(Channel).filter(Channel.id == channel_id).first()
+        # Returns the channel without a query if it is already contained in the session
+        channel = self.session.query(Channel).get(channel_id)
+        if channel is None or (self.bot is not None and channel.bot != self.bot):
+            return None
+        return channel
 
     def get_channels(self) -> List[Channel]:
-        return self.session.query(Channel).all()
+        if self._channels is None:
+            with self._replica():
+                self._channels = self._query_channels().all()
+        return self._channels
+
+    def get_all_channels(self) -> List[Channel]:
+        """Channels of all bots."""
+        with self._replica():
+            return self.session.query(Channel).all()
+
+    def get_channels_by_names(self, names: List[str]) -> List[Channel]:
+        if len(names) == 0:
+            return []
+        if self._channels is not None:
+            lower_names = set(name.lower() for name in names)
+            return [channel for channel in self._channels if channel.name.lower() in lower_names]
+        with self._replica():
+            return self._query_channels().filter(Channel.name.in_(names)).all()
+
+    def get_subscriber_chat_ids(self, channel_ids: List[int]) -> List[int]:
+        """Chat ids of all users that subscribed at least one of the channels (every user is contained only once)."""
+        if len(channel_ids) == 0:
+            return []
+        query = self.session.query(user_channels.columns['chat_id'])\
+            .filter(user_channels.columns['channel_id'].in_(channel_ids)).distinct()
+        with self._replica():
+            return [row[0] for row in query.all()]
+
+    def count_subscribers(self, channel_ids: List[int]) -> int:
+        if len(channel_ids) == 0:
+            return 0
+        with self._replica():
+            return self.session.query(func.count(distinct(user_channels.columns['chat_id'])))\
+                .filter(user_channels.columns['channel_id'].in_(channel_ids)).scalar()
+
+    def add_broadcast(self, sender_chat_id, channels: List[str], message_types: List[str]) -> Broadcast:
+        broadcast = Broadcast(sender_chat_id, ",".join(channels), ",".join(message_types))
+        broadcast.bot = self.bot or ''
+        self.session.add(broadcast)
+        self.session.flush()
+        return broadcast
+
+    def add_broadcast_recipients(self, broadcast_id: int, recipients: List[tuple]):
+        """Stores the message ids for the given (chat_id, [message_id, ...]) pairs with a single INSERT."""
+        if len(recipients) == 0:
+            return
+        self.session.execute(BroadcastRecipient.__table__.insert(),
+                             [{'broadcast_id': broadcast_id,
+                               'chat_id': chat_id,
+                               'message_ids': ",".join(map(str, message_ids))}
+                              for chat_id, message_ids in recipients])
+
+    def _query_broadcasts(self):
+        query = self.session.query(Broadcast)
+        if self.bot is not None:
+            query = query.filter(Broadcast.bot == self.bot)
+        return query
+
+    def get_broadcast(self, broadcast_id: int) -> Broadcast:
+        broadcast = self.session.query(Broadcast).get(broadcast_id)
+        if broadcast is None or (self.bot is not None and broadcast.bot != self.bot):
+            return None
+        return broadcast
+
+    def get_broadcasts_by_sender(self, sender_chat_id, limit: int) -> List[Broadcast]:
+        return self._query_broadcasts().filter(Broadcast.sender_chat_id == sender_chat_id)\
+            .order_by(Broadcast.id.desc()).limit(limit).all()
+
+    def get_broadcast_recipients(self, broadcast_id: int, after_chat_id, limit: int) -> List[BroadcastRecipient]:
+        query = self.session.query(BroadcastRecipient).filter(BroadcastRecipient.broadcast_id == broadcast_id)
+        if after_chat_id is not None:
+            query = query.filter(BroadcastRecipient.chat_id > after_chat_id)
+        return query.order_by(BroadcastRecipient.chat_id).limit(limit).all()
+
+    def finish_broadcast_sending(self, broadcast_id: int):
+        self.session.query(Broadcast).filter(Broadcast.id == broadcast_id)\
+            .update({Broadcast.sending_done: True}, synchronize_session=False)
+
+    def finish_interrupted_broadcast_sending(self) -> int:
+        """Marks broadcasts whose sending was interrupted by a restart as done and returns their number."""
+        return self._query_broadcasts().filter(Broadcast.sending_done.is_(False))\
+            .update({Broadcast.sending_done: True}, synchronize_session=False)
+
+    def get_running_broadcast_jobs(self) -> List[Broadcast]:
+        return self._query_broadcasts().filter(Broadcast.job_state == 'running').all()
 
     def get_unsubscribed_channels(self, chat_id: int):
-        subquery = self.session.query(user_channels.columns['channel_id'])\
-            .filter(user_channels.columns['chat_id'] == chat_id).subquery('subquery')
-        return self.session.query(Channel).filter(Channel.id.notin_(subquery)).all()
+        user = self.get_user_by_chat_id(chat_id)
+        subscribed_channel_ids = set(channel.id for channel in user.channels.values()) if user is not None else set()
+        return [channel for channel in self.get_channels() if channel.id not in subscribed_channel_ids]
 
 
 class MyDatabase:
     db_engine = None
 
-    def __init__(self, database_url):
+    replica_engine = None
+
+    # Sessions are restricted to the users and channels of this bot (None: all bots)
+    bot = None
+
+    def __init__(self, database_url, replica_url=None):
+        # Creating the engines does not connect to the database yet
         self.db_engine = create_engine(database_url, pool_pre_ping=True, echo=False)
+        if replica_url is not None:
+            self.replica_engine = create_engine(replica_url, pool_pre_ping=True, echo=False)
+        self.Session = sessionmaker(class_=RoutingSession, bind=self.db_engine, replica_bind=self.replica_engine)
+        # Schema creation/check is done when the first session is requested
+        self.schema = LazyInitializer('database', self._create_schema)
+
+    def get_session(self) -> MyDatabaseSession:
+        self.schema.ensure()
+        return MyDatabaseSession(self.Session(), self.bot)
+
+    def for_bot(self, bot: str) -> 'MyDatabase':
+        """Returns a view of the database restricted to the given bot, sharing engines and schema with this one."""
+        view = copy.copy(self)
+        view.bot = bot
+        return view
+
+    def _create_schema(self):
+        existing_tables = inspect(self.db_engine).get_table_names()
         try:
             # TODO: Check whether schema is correct if it already exists
             Base.metadata.create_all(self.db_engine)
+            if self.replica_engine is not None:
+                # Usually the tables exist on the replica through replication, so this does nothing. It is needed for
+                # local tests with two separate databases.
+                Base.metadata.create_all(self.replica_engine)
             # print("Tables created")
         except Exception as e:
             print("Error occurred during Table creation!")
             print(e)
-        self.Session = sessionmaker(bind=self.db_engine)
-
-    def get_session(self) -> MyDatabaseSession:
-        return MyDatabaseSession(self.Session())
+            raise
+        self._migrate_subscriber_count()
+        self._migrate_user_channels_index()
+        self._migrate_bot_namespaces(existing_tables)
+        self._migrate_broadcast_sending_done()
+        self._migrate_channel_name_constraint()
+
+    def _migrate_channel_name_constraint(self):
+        # Channel names were unique across all bots before every bot got its own channel names
+        constraints = inspect(self.db_engine).get_unique_constraints(Channel.__tablename__)
+        old_constraints = [constraint for constraint in constraints if constraint['column_names'] == ['name']]
+        if len(old_constraints) == 0:
+            return
+        if self.db_engine.dialect.name == 'sqlite':
+            self._rebuild_sqlite_table(Channel.__table__)
+            return
+        old_constraint = UniqueConstraint('name', name=old_constraints[0]['name'])
+        # The constraint needs a table to be dropped, only its name matters
+        Table(Channel.__tablename__, MetaData(), Column('name', String(255)), old_constraint)
+        new_constraint = [constraint for constraint in Channel.__table__.constraints
+                          if constraint.name == 'uq_channels_bot_name'][0]
+        with self.db_engine.begin() as connection:
+            connection.execute(DropConstraint(old_constraint))
+            connection.execute(AddConstraint(new_constraint))
+
+    def _rebuild_sqlite_table(self, table: Table):
+        # SQLite cannot drop constraints, so the table is copied into a new one with the current definition (see
+        # https://www.sqlite.org/lang_altertable.html#otheralter). The foreign keys of other tables refer to the table
+        # by name and are kept, as they are not enforced meanwhile.
+        new_table = table.tometadata(MetaData(), name=table.name + '_new')
+        connection = self.db_engine.connect()
+        try:
+            connection.execute("PRAGMA foreign_keys=OFF")
+            with connection.begin():
+                new_table.create(connection)
+                connection.execute(new_table.insert().from_select([column.name for column in table.columns],
+                                                                  select([table])))
+                connection.execute("DROP TABLE {0}".format(table.name))
+                connection.execute("ALTER TABLE {0} RENAME TO {1}".format(new_table.name, table.name))
+        finally:
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.close()
+
+    def _migrate_broadcast_sending_done(self):
+        # Broadcasts stored before the column was introduced were sent completely
+        columns = [column['name'] for column in inspect(self.db_engine).get_columns(Broadcast.__tablename__)]
+        if 'sending_done' not in columns:
+            with self.db_engine.begin() as connection:
+                connection.execute("ALTER TABLE broadcasts ADD COLUMN sending_done BOOLEAN NOT NULL DEFAULT 1")
+
+    def _migrate_bot_namespaces(self, existing_tables: List[str]):
+        # Databases created before several bots could be served by one process belong to the main bot ('')
+        inspector = inspect(self.db_engine)
+        with self.db_engine.begin() as connection:
+            for table in [Channel.__tablename__, Broadcast.__tablename__]:
+                if 'bot' not in [column['name'] for column in inspector.get_columns(table)]:
+                    connection.execute("ALTER TABLE {0} ADD COLUMN bot VARCHAR(64) NOT NULL DEFAULT ''".format(table))
+            if bot_users.name not in existing_tables and User.__tablename__ in existing_tables:
+                connection.execute(bot_users.insert().from_select(['bot', 'chat_id'],
+                                                                  select([literal(''), User.chat_id])))
+
+    def _migrate_user_channels_index(self):
+        # create_all() does not add indexes to existing tables
+        indexes = [index['name'] for index in inspect(self.db_engine).get_indexes(user_channels.name)]
+        if 'ix_user_channels_channel_id' not in indexes:
+            for index in user_channels.indexes:
+                if index.name == 'ix_user_channels_channel_id':
+                    index.create(self.db_engine)
+
+    def _migrate_subscriber_count(self):
+        # Databases created before the subscriber counters were introduced lack the column
+        columns = [column['name'] for column in inspect(self.db_engine).get_columns(Channel.__tablename__)]
+        if 'subscriber_count' in columns:
+            return
+        with self.db_engine.begin() as connection:
+            connection.execute("ALTER TABLE channels ADD COLUMN subscriber_count INTEGER NOT NULL DEFAULT 0")
+        # We cannot use get_session() here as the schema is not marked as ready yet
+        session = MyDatabaseSession(self.Session())
+        try:
+            session.reconcile_subscriber_counts()
+            session.commit()
+        finally:
+            session.close()
 
 
 @contextmanager
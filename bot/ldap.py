@@ -1,19 +1,43 @@
+import threading
+
 from ldap3 import Server, Connection, RESTARTABLE, SYNC
 
+import profiling
+from readiness import LazyInitializer
+
 
 class LdapAccess:
     base_group_filter = None
-    conn = None
+    _conn = None
 
-    def __init__(self, server_url, user, password, base_group_filter):
+    def __init__(self, server_url, user, password, base_group_filter,
+                 client_strategy=RESTARTABLE, credential_strategy=SYNC):
         self.base_group_filter = base_group_filter
+        self.user = user
+        self.password = password
+        # The strategies can be replaced, e.g., by MOCK_SYNC for tests without an LDAP server
+        self.client_strategy = client_strategy
+        self.credential_strategy = credential_strategy
+        # Creating the server object does not open a connection
         self.server = Server(server_url)
+        # The connection is bound when it is needed for the first time
+        self.connection = LazyInitializer('ldap', self._bind)
+        # The connection is shared by all threads, but conn.response belongs to the last search on it, so searching
+        # and reading the response must not be interleaved with the search of another thread
+        self._search_lock = threading.Lock()
+
+    def _bind(self):
         conn = Connection(self.server,
-                          user=user,
-                          password=password,
-                          client_strategy=RESTARTABLE)
+                          user=self.user,
+                          password=self.password,
+                          client_strategy=self.client_strategy)
         conn.bind()
-        self.conn = conn
+        self._conn = conn
+
+    @property
+    def conn(self) -> Connection:
+        self.connection.ensure()
+        return self._conn
 
     def check_usergroup(self, username) -> bool:
         return self.check_filter(username, self.base_group_filter)
@@ -22,14 +46,26 @@ class LdapAccess:
         if ldap_filter is None:
             return False
         # Use the username as base to decide whether it belongs to group
-        self.conn.search(username, ldap_filter)
-        return len(self.conn.response) == 1
+        with profiling.measure('ldap'), self._search_lock:
+            self.conn.search(username, ldap_filter)
+            return len(self.conn.response) == 1
+
+    def check_all_filters(self, username, ldap_filters) -> bool:
+        """Checks with a single query whether the user matches every one of the filters."""
+        if len(ldap_filters) == 0:
+            return True
+        if any(ldap_filter is None or len(ldap_filter) == 0 for ldap_filter in ldap_filters):
+            return False
+        if len(ldap_filters) == 1:
+            return self.check_filter(username, ldap_filters[0])
+        return self.check_filter(username, "(&" + "".join(ldap_filters) + ")")
 
     def check_credentials(self, username, password) -> bool:
         credential_conn = Connection(self.server,
                                      user=username,
                                      password=password,
-                                     client_strategy=SYNC)
-        ret = credential_conn.bind()
-        credential_conn.unbind()
+                                     client_strategy=self.credential_strategy)
+        with profiling.measure('ldap'):
+            ret = credential_conn.bind()
+            credential_conn.unbind()
         return ret
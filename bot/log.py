@@ -0,0 +1,111 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import random
+from queue import Queue
+
+from conf import Conf
+
+# Attributes every LogRecord has; everything else was passed using the extra parameter and is written as a field
+_STANDARD_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__.keys()) | {'message', 'asctime'}
+
+_listeners = []
+
+# Parent of the loggers of the bot's modules (see get_logger). Its handlers are created by telegram_shoutout_bot, so
+# the records of all modules are written to the error log.
+BOT_LOGGER = 'shoutout'
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_RECORD_ATTRIBUTES and key != 'sampled':
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets only a fraction of the records through that are marked with extra={'sampled': True}."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'sampled', False):
+            return random.random() < self.rate
+        return True
+
+
+class _StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The default implementation merges the traceback into the message; we keep it apart for the JSON output.
+        # Arguments are resolved here as they might not be safe to access from another thread later.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def create_logger(name: str, filename: str, stream: bool = False, rotate: bool = True) -> logging.Logger:
+    """Creates a logger whose records are written by a background thread, so that handlers never block on file I/O.
+
+    The log file is written as JSON lines and rotated when it reaches Conf.log_max_bytes. Files written by several
+    processes must not be rotated by one of them (the others would keep writing to the rotated file), for those rotate
+    has to be False: the file is reopened when it was moved by an external tool like logrotate.
+    """
+    if rotate:
+        file_handler = logging.handlers.RotatingFileHandler(filename,
+                                                            maxBytes=Conf.log_max_bytes,
+                                                            backupCount=Conf.log_backup_count,
+                                                            encoding='utf-8')
+    else:
+        file_handler = logging.handlers.WatchedFileHandler(filename, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if stream:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        handlers.append(stream_handler)
+
+    queue = Queue(-1)
+    listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+    queue_handler = _StructuredQueueHandler(queue)
+    # Drop sampled records before they are enqueued
+    queue_handler.addFilter(SamplingFilter(Conf.log_sample_rate))
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(queue_handler)
+    return logger
+
+
+def get_logger(module_name: str) -> logging.Logger:
+    """Returns the logger for a module of the bot (a child of BOT_LOGGER)."""
+    return logging.getLogger(BOT_LOGGER + '.' + module_name)
+
+
+@atexit.register
+def _stop_listeners():
+    # Flush all records that are still queued
+    for listener in _listeners:
+        listener.stop()
@@ -0,0 +1,63 @@
+import time
+from typing import List
+
+import db
+import log
+from db import my_session_scope
+
+logger = log.get_logger(__name__)
+
+
+class BackfillResult:
+    def __init__(self):
+        # Added subscriptions by channel name
+        self.added = {}
+        self.removed = 0
+        # Channels whose subscriber counter had to be corrected
+        self.reconciled = 0
+        self.duration = 0.0
+
+
+def backfill_subscriptions(my_database: db.MyDatabase, channel_names: List[str] = None,
+                           batch_size: int = 5000) -> BackfillResult:
+    """Subscribes all existing users to the mandatory channels (and to the given channels), removes subscriptions of
+    users or channels that do not exist anymore and finally recalculates the subscriber counters.
+
+    Default channels are only added when they are named, as users may have unsubscribed them on purpose. The work is
+    split into batches of users, each committed separately, so that no lock is held for long.
+    """
+    start = time.perf_counter()
+    result = BackfillResult()
+    lower_names = set(name.lower() for name in channel_names or [])
+    with my_session_scope(my_database) as session:  # type: db.MyDatabaseSession
+        channels = {channel.id: channel.name for channel in session.get_channels()
+                    if channel.mandatory or channel.name.lower() in lower_names}
+    for name in channels.values():
+        result.added[name] = 0
+
+    after_chat_id = None
+    while len(channels) > 0:
+        with my_session_scope(my_database) as session:  # type: db.MyDatabaseSession
+            batch_end = session.get_chat_id_batch_end(after_chat_id, batch_size)
+            if batch_end is None:
+                break
+            for channel_id, name in channels.items():
+                result.added[name] += session.add_missing_subscriptions(channel_id, after_chat_id, batch_end)
+        after_chat_id = batch_end
+
+    while True:
+        with my_session_scope(my_database) as session:  # type: db.MyDatabaseSession
+            removed = session.remove_orphaned_subscriptions(batch_size)
+        if removed == 0:
+            break
+        result.removed += removed
+
+    with my_session_scope(my_database) as session:  # type: db.MyDatabaseSession
+        result.reconciled = session.reconcile_subscriber_counts()
+
+    result.duration = time.perf_counter() - start
+    logger.info("Backfill added {0} and removed {1} subscriptions in {2:.3f} s, corrected {3} counters"
+                .format(sum(result.added.values()), result.removed, result.duration, result.reconciled),
+                extra={'added': result.added, 'removed': result.removed, 'reconciled': result.reconciled,
+                       'duration': result.duration})
+    return result
@@ -0,0 +1,90 @@
+import threading
+from typing import List, Tuple
+
+import db
+import ldap
+import log
+from db import Channel, MyDatabaseSession, UserPermission, my_session_scope
+
+logger = log.get_logger(__name__)
+
+
+class PermissionSync:
+    """Evaluates the LDAP filters for all users connected to an LDAP account and stores the results in the database.
+
+    The handlers read the admin status and the channels a user may write to from this snapshot, so that they do not
+    depend on the LDAP server being fast or available. The snapshot is refreshed every interval seconds in a background
+    thread and can be refreshed on demand with sync() and sync_user().
+    """
+
+    def __init__(self, my_database: db.MyDatabase, ldap_access: ldap.LdapAccess, interval: float):
+        self.my_database = my_database
+        self.ldap_access = ldap_access
+        self.interval = interval
+        # Only one full synchronization at a time
+        self._sync_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='permission_sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.sync()
+            except Exception:
+                # The previous snapshot stays valid until the next successful synchronization
+                logger.exception("Synchronization of the LDAP permissions failed")
+            self._stopped.wait(self.interval)
+
+    def evaluate(self, ldap_account: str, channels: List[Channel]) -> Tuple[bool, List[int]]:
+        """Returns whether the account has admin rights and the ids of the channels it may write to."""
+        admin = self.ldap_access.check_usergroup(ldap_account)
+        for channel in channels:
+            if channel.ldap_filter is None or len(channel.ldap_filter) == 0:
+                logger.warning("No LDAP filter configured for channel {0}. Denying access.".format(channel.name))
+        # In the common case the account may write to all channels, which can be checked with a single LDAP query
+        if self.ldap_access.check_all_filters(ldap_account, [channel.ldap_filter for channel in channels]):
+            return admin, [channel.id for channel in channels]
+        return admin, [channel.id for channel in channels
+                       if self.ldap_access.check_filter(ldap_account, channel.ldap_filter)]
+
+    def sync(self) -> int:
+        """Refreshes the snapshot of all users and returns their number."""
+        with self._sync_lock:
+            with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
+                accounts = session.get_ldap_accounts()
+                channels = session.get_all_channels()
+                # All LDAP queries are made before anything is written, so that a failing LDAP server leaves the
+                # previous snapshot untouched
+                results = {}
+                for ldap_account in set(ldap_account for _, ldap_account in accounts):
+                    results[ldap_account] = self.evaluate(ldap_account, channels)
+                for chat_id, ldap_account in accounts:
+                    admin, channel_ids = results[ldap_account]
+                    session.set_permission(chat_id, ldap_account, admin, channel_ids)
+        logger.info("Synchronized the LDAP permissions of {0} users".format(len(accounts)))
+        return len(accounts)
+
+    def sync_user(self, session: MyDatabaseSession, user: db.User) -> UserPermission:
+        """Refreshes the snapshot of a single user in the given session."""
+        admin, channel_ids = self.evaluate(user.ldap_account, session.get_all_channels())
+        return session.set_permission(user.chat_id, user.ldap_account, admin, channel_ids)
+
+    def get_permission(self, session: MyDatabaseSession, user: db.User) -> UserPermission:
+        """Returns the snapshot of the user (None if the user is not connected to an LDAP account).
+
+        Users that are not contained in the snapshot yet (e.g., because they registered after the last
+        synchronization) are evaluated immediately.
+        """
+        if user is None or user.ldap_account is None:
+            return None
+        permission = session.get_permission(user.chat_id)
+        if permission is None or permission.ldap_account != user.ldap_account:
+            permission = self.sync_user(session, user)
+        return permission
@@ -0,0 +1,168 @@
+import heapq
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import sqlalchemy.engine
+from sqlalchemy import event
+
+_BOT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Time spent in the database and in LDAP by the update that is handled by the current thread (only while profiling)
+_timings = threading.local()
+
+
+@contextmanager
+def measure(kind: str):
+    """Adds the duration of the block to the given kind of the current update if the profiler is running."""
+    timings = getattr(_timings, 'current', None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[kind] += time.perf_counter() - start
+
+
+@event.listens_for(sqlalchemy.engine.Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_timings, 'current', None) is not None:
+        conn.info.setdefault('profiling_start', []).append(time.perf_counter())
+
+
+@event.listens_for(sqlalchemy.engine.Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = getattr(_timings, 'current', None)
+    if timings is not None and len(conn.info.get('profiling_start', [])) > 0:
+        timings['db'] += time.perf_counter() - conn.info['profiling_start'].pop()
+
+
+class Profiler:
+    """Sampling profiler for the threads handling updates, which can be switched on for a limited time.
+
+    While it is running, the stacks of the dispatcher and of the threads handling updates are sampled every interval
+    seconds and the duration of every update is recorded together with its time in the database and in LDAP. While it
+    is not running, the only overhead is a check of the active flag per update, database query and LDAP query.
+    """
+
+    def __init__(self, interval: float = 0.005, top: int = 15, slowest: int = 10):
+        self.interval = interval
+        self.top = top
+        self.slowest = slowest
+        self.active = False
+        self._lock = threading.Lock()
+        self._busy_threads = set()
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.self_counts = defaultdict(int)
+        self.total_counts = defaultdict(int)
+        self.updates_by_label = defaultdict(lambda: {'count': 0, 'total': 0.0, 'db': 0.0, 'ldap': 0.0})
+        self.slowest_updates = []
+
+    def start(self, duration: float, on_finish) -> bool:
+        """Profiles for duration seconds and calls on_finish with the report. Returns False if already running."""
+        with self._lock:
+            if self.active:
+                return False
+            self._reset()
+            self.active = True
+        threading.Thread(target=self._sample, args=(duration, on_finish), name='profiler', daemon=True).start()
+        return True
+
+    def run_update(self, label_function, func, *args):
+        """Runs func(*args) and records its duration under the label returned by label_function if profiling."""
+        if not self.active:
+            return func(*args)
+        thread_id = threading.get_ident()
+        _timings.current = {'db': 0.0, 'ldap': 0.0}
+        with self._lock:
+            self._busy_threads.add(thread_id)
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            duration = time.perf_counter() - start
+            timings = _timings.current
+            _timings.current = None
+            with self._lock:
+                self._busy_threads.discard(thread_id)
+            self._record_update(label_function(), duration, timings)
+
+    def _record_update(self, label, duration, timings):
+        with self._lock:
+            if not self.active:
+                return
+            stats = self.updates_by_label[label]
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['db'] += timings['db']
+            stats['ldap'] += timings['ldap']
+            entry = (duration, label, timings['db'], timings['ldap'])
+            if len(self.slowest_updates) < self.slowest:
+                heapq.heappush(self.slowest_updates, entry)
+            else:
+                heapq.heappushpop(self.slowest_updates, entry)
+
+    def _sample(self, duration, on_finish):
+        own_id = threading.get_ident()
+        dispatcher_ids = set(thread.ident for thread in threading.enumerate() if thread.name.endswith(':dispatcher'))
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id in dispatcher_ids | self._busy_threads:
+                    frame = frames.get(thread_id)
+                    if thread_id != own_id and frame is not None:
+                        self._add_stack(frame)
+            time.sleep(self.interval)
+        with self._lock:
+            self.active = False
+        on_finish(self.report(duration))
+
+    def _add_stack(self, frame):
+        keys = []
+        while frame is not None:
+            code = frame.f_code
+            # The dispatcher waiting for new updates is not interesting
+            if code.co_name == 'get' and code.co_filename.endswith('queue.py'):
+                return
+            keys.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        self.samples += 1
+        self.self_counts[keys[0]] += 1
+        for key in set(keys):
+            self.total_counts[key] += 1
+
+    def report(self, duration: float) -> str:
+        def name(key):
+            return "{0} ({1}:{2})".format(key[0], os.path.basename(key[1]), key[2])
+
+        def share(count):
+            return 100 * count / self.samples
+
+        lines = ["Profil über {0:.0f} s ({1} Stichproben)".format(duration, self.samples), "",
+                 "Heißeste Funktionen (eigene Zeit):"]
+        for key, count in sorted(self.self_counts.items(), key=lambda item: -item[1])[:self.top]:
+            lines.append("{0:5.1f}% {1}".format(share(count), name(key)))
+        # Where the time is spent from the perspective of the bot's own code (including called functions)
+        lines += ["", "Funktionen des Bots (inklusive Aufrufe):"]
+        own_keys = [key for key in self.total_counts if os.path.dirname(key[1]) == _BOT_DIRECTORY]
+        for key in sorted(own_keys, key=lambda own_key: -self.total_counts[own_key])[:self.top]:
+            lines.append("{0:5.1f}% {1}".format(share(self.total_counts[key]), name(key)))
+        lines += ["", "Updates (Anzahl, Summe, davon Datenbank / LDAP):"]
+        for label, stats in sorted(self.updates_by_label.items(), key=lambda item: -item[1]['total']):
+            lines.append("{0}: {1}x {2:.1f} ms (DB {3:.1f} ms / LDAP {4:.1f} ms)"
+                         .format(label, stats['count'], 1000 * stats['total'], 1000 * stats['db'],
+                                 1000 * stats['ldap']))
+        lines += ["", "Langsamste Updates (Dauer, davon Datenbank / LDAP):"]
+        for update_duration, label, db_time, ldap_time in sorted(self.slowest_updates, reverse=True):
+            lines.append("{0:.1f} ms {1} (DB {2:.1f} ms / LDAP {3:.1f} ms)"
+                         .format(1000 * update_duration, label, 1000 * db_time, 1000 * ldap_time))
+        return "\n".join(lines)
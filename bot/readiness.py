@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable
+
+NOT_INITIALIZED = 'not initialized'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class LazyInitializer:
+    """Runs the initialization of a dependency on first use and keeps track of its state.
+
+    If the initialization fails, it is retried on the next call of ensure().
+    """
+
+    def __init__(self, name: str, function: Callable[[], None]):
+        self.name = name
+        self.function = function
+        self.status = NOT_INITIALIZED
+        self.duration = None
+        self.error = None
+        self.ready_since = None
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        if self.status == READY:
+            return
+        with self._lock:
+            if self.status == READY:
+                return
+            start = time.monotonic()
+            try:
+                self.function()
+                self.status = READY
+                self.error = None
+                self.ready_since = time.time()
+            except Exception as e:
+                self.status = FAILED
+                self.error = e
+                raise
+            finally:
+                self.duration = time.monotonic() - start
+
+    def report(self) -> dict:
+        return {'status': self.status,
+                'duration': self.duration,
+                'ready_since': self.ready_since,
+                'error': str(self.error) if self.error is not None else None}
+
+
+class StartupTimer:
+    """Measures the duration of the individual startup phases."""
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - start
+
+    def total(self) -> float:
+        return sum(self.phases.values())
@@ -1,16 +1,22 @@
 #!/usr/bin/python3
-import logging
+import functools
+import html
 import random
+import signal
 import string
 import sys
+import threading
+import time
 import traceback
 import warnings
 from collections import OrderedDict
 from queue import Queue, Empty
-from typing import Iterable, List, Callable
+from typing import Callable, Iterable, List, Tuple
 
 import telegram.bot
+import telegram.error
 from telegram import Message, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InputMediaPhoto, InputMediaVideo
 from telegram import Update
 from telegram.ext import messagequeue as mq, CallbackQueryHandler
 from telegram.ext import ConversationHandler, CallbackContext
@@ -20,39 +26,40 @@ from telegram.ext import MessageHandler, Filters
 from db import MyDatabaseSession, Channel, User
 from db import my_session_scope
 from conf import Conf
+import admission
+import broadcast
+import broadcast_jobs
 import db
 import ldap
-
-# Logging
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(Conf.error_log)
-stream_handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-stream_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
-# Log for admin actions
-adminLogger = logging.getLogger('TelegramShoutoutBot.admin')
-adminLogger.setLevel(logging.INFO)
-admin_file_handler = logging.FileHandler(Conf.admin_log)
-admin_file_handler.setFormatter(formatter)
-adminLogger.addHandler(admin_file_handler)
-# Log for admin actions
-userLogger = logging.getLogger('TelegramShoutoutBot.user')
-userLogger.setLevel(logging.INFO)
-user_file_handler = logging.FileHandler(Conf.user_log)
-user_file_handler.setFormatter(formatter)
-userLogger.addHandler(user_file_handler)
+import log
+import maintenance
+import permissions
+import profiling
+import readiness
+import tenants
+import workers
+
+# Logging (records are written by background threads, see log.py). The error log receives the records of all modules
+# of the bot, the logs for admin and user actions are created per bot, see TelegramShoutoutBot.__init__.
+log.create_logger(log.BOT_LOGGER, Conf.error_log, stream=True)
+logger = log.get_logger(__name__)
 
 # States for conversation
 SEND_CHANNEL, SEND_MESSAGE, SEND_CONFIRMATION, SUBSCRIBE_CHANNEL, UNSUBSCRIBE_CHANNEL = range(0, 5)
 
 # Keyboard callback data
-CB_SEND_DONE, CB_SEND_CONFIRM, CB_SEND_CANCEL, CB_SUBSCRIBE_CANCEL, CB_UNSUBSCRIBE_CANCEL = map(str, range(5, 10))
+CB_SEND_DONE, CB_SEND_CONFIRM, CB_SEND_CANCEL, CB_SUBSCRIBE_CANCEL, CB_UNSUBSCRIBE_CANCEL, CB_SEND_CHANNELS_DONE = \
+    map(str, range(5, 11))
 CB_CHANNEL_PREFIX = 'CH'
 CB_CHANNEL_REGEX = r"^" + CB_CHANNEL_PREFIX + r"(\d+)"
+CB_PAGE_PREFIX = 'PG'
+CB_PAGE_REGEX = r"^" + CB_PAGE_PREFIX + r"(\d+)"
+
+# Channel buttons per keyboard page (Telegram rejects inline keyboards that are too large)
+CHANNEL_KEYBOARD_PAGE_SIZE = 20
+
+# Maximum delay between the attempts to reach the Telegram Bot API at startup (in seconds)
+BOT_API_RETRY_MAX_DELAY = 60
 
 # TODO: Implement /help and /settings (standard commands according to Telegram documentation)
 # TODO: Exception Handling (e.g., for database queries)
@@ -74,31 +81,88 @@ ADMIN_COMMANDS = OrderedDict(
     [('admin', 'Eigenen Admin-Status anzeigen'),
      ('register', 'Eigenen Account mit einem DPSG-Account verknüpfen'),
      ('unregister', 'Verknüpfung zum DPSG-Account lösen'),
-     ('send', 'Nachricht an Abonnenten senden')
+     ('refresh', 'Berechtigungen neu aus dem DPSG-Account laden'),
+     ('send', 'Nachricht an Abonnenten senden'),
+     ('broadcasts', 'Eigene Versände anzeigen'),
+     ('edit', 'Text eines Versands ändern'),
+     ('recall', 'Versand bei allen Empfängern löschen')
      ]
 )
 
 
+class RenderCache:
+    """Thread-safe LRU cache for rendered responses. The keys contain everything that is displayed, so changes of the
+    channel catalog (also those made directly in the database) lead to new entries."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render: Callable):
+        """Returns the cached value for the key, calling render() to create it if it is missing."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = render()
+        with self._lock:
+            self._entries[key] = value
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+
 class SendData:
     # botm stands for bot message and contains messages that were sent by the bot and maybe need to be
     # edited/deleted later
     botm_choose_channel = None
     botm_add_messages = None
     botm_confirmation = None
-    channel = None
+    channels = None
     messages = None
 
 
+class SharedResources:
+    """Resources shared by all bots served by the process: database engines, LDAP, the permission snapshot, the
+    worker threads and the profiler."""
+
+    def __init__(self, ldap_access: ldap.LdapAccess = None, bot_count: int = 1):
+        from telegram.utils.request import Request
+
+        # Database, LDAP and Bot API are initialized on first use, so that they cannot delay the startup
+        self.startup_timer = readiness.StartupTimer()
+        with self.startup_timer.phase('database'):
+            self.my_database = db.MyDatabase(Conf.database_url, Conf.database_replica_url)
+
+        with self.startup_timer.phase('ldap'):
+            if ldap_access is None:
+                ldap_access = ldap.LdapAccess(Conf.ldap_server, Conf.ldap_user,
+                                              Conf.ldap_password, Conf.ldap_base_group_filter)
+            self.ldap_access = ldap_access
+            self.permission_sync = permissions.PermissionSync(self.my_database, self.ldap_access,
+                                                              Conf.permission_sync_interval)
+
+        with self.startup_timer.phase('workers'):
+            # The connection pool is not bound to a token, so the bots share it (polling blocks one connection each)
+            self.request = Request(con_pool_size=4 + 4 * bot_count)
+            self.worker_pool = workers.ChatWorkerPool(Conf.worker_threads, Conf.max_pending_updates)
+            self.profiler = profiling.Profiler()
+
+    def start(self):
+        self.permission_sync.start()
+
+    def stop(self):
+        self.permission_sync.stop()
+        self.worker_pool.stop()
+
+
 class TelegramShoutoutBot:
     my_database: db.MyDatabase = None
     ldap_access: ldap.LdapAccess = None
-    # We use the following queue to store chat ids and message ids of messages containing inline keyboards, so that
-    # those can be deleted when not needed anymore (as they could have unwanted side effects). This queue has to be
-    # thread-safe as it is filled by the asynchronous calls triggered by the message queue.
-    keyboard_message_queue = Queue()
-    # The message ids are stored in the following dictionary by user when they are read from the queue. This dictionary
-    # is only accessed from the main thread, so it does not need to be handled in a thread-safe way.
-    keyboard_message_user_lists = {}
+    # Rendered channel lists and keyboards by the shown channels (see create_channel_list)
+    channel_list_cache = RenderCache()
+    channel_keyboard_cache = RenderCache()
 
     def cmd_start(self, update: Update, context: CallbackContext):
         self.remove_all_inline_keyboards(update, context)
@@ -122,17 +186,12 @@ class TelegramShoutoutBot:
     def cmd_help(self, update: Update, context: CallbackContext):
         self.remove_all_inline_keyboards(update, context)
         chat_id = update.effective_chat.id
-        answer = "<b>Verfügbare Kommandos:</b>\n"
-        for key, val in GENERAL_COMMANDS.items():
-            answer += "/{0} - {1}\n".format(key, val)
-        answer += "\n<b>Befehle für Administratoren:</b>\n"
-        for key, val in ADMIN_COMMANDS.items():
-            answer += "/{0} - {1}\n".format(key, val)
+        answer = TelegramShoutoutBot.create_help_text()
         context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
 
     def cmd_impressum(self, update: Update, context: CallbackContext):
         self.remove_all_inline_keyboards(update, context)
-        answer = "Das Impressum für diesen Dienst befindet sich auf " + Conf.url_impressum
+        answer = "Das Impressum für diesen Dienst befindet sich auf " + self.config.url_impressum
         context.bot.send_message(chat_id=update.effective_chat.id, text=answer)
 
     def cmd_admin(self, update: Update, context: CallbackContext):
@@ -144,7 +203,7 @@ class TelegramShoutoutBot:
                 answer = self.get_message_user_not_known()
             elif user.ldap_account is None:
                 answer = "Du hast <i>keinen</i> DPSG-Account mit deinem Telegram-Zugang verbunden."
-            elif self.ldap_access.check_usergroup(user.ldap_account):
+            elif self.is_admin(session, user):
                 accessible_channels: List[Channel] = self.get_accessible_channels(session, user)
                 answer = "Du hast einen DPSG-Account mit deinem Telegram-Zugang verbunden " \
                          "und hast Admin-Rechte in Telegram.\n\n" \
@@ -189,7 +248,8 @@ class TelegramShoutoutBot:
             else:
                 ldap_account_name = user.ldap_account
                 session.remove_ldap(chat_id)
-                userLogger.info("User {0} removed his account connection to {1}.".format(chat_id, ldap_account_name))
+                self.user_logger.info("User {0} removed his account connection to {1}."
+                                      .format(chat_id, ldap_account_name))
                 answer = "Account-Zuordnung entfernt"
             context.bot.send_message(chat_id=chat_id, text=answer)
 
@@ -202,18 +262,18 @@ class TelegramShoutoutBot:
             if user is None:
                 context.bot.send_message(chat_id=chat_id, text=self.get_message_user_not_known())
                 return ConversationHandler.END
-            elif user.ldap_account is not None and self.ldap_access.check_usergroup(user.ldap_account):
+            elif self.is_admin(session, user):
                 send_data: SendData = SendData()
+                send_data.channels = []
                 context.user_data["send"] = send_data
                 accessible_channels: List[Channel] = self.get_accessible_channels(session, user)
                 answer = "<b>Nachricht senden</b>\n\n" \
-                         "Bitte Kanal eingeben, an den die Nachricht gesendet werden soll.\n\n" \
+                         "Bitte Kanäle eingeben, an die die Nachricht gesendet werden soll. " \
+                         "Mehrere Kanäle können durch Kommas getrennt angegeben werden. " \
+                         "Mit /done geht es weiter zur Eingabe der Nachrichten.\n\n" \
                          "Verfügbare Kanäle:\n" + TelegramShoutoutBot.create_channel_list(accessible_channels)
-                reply_markup = TelegramShoutoutBot.create_channel_keyboard(accessible_channels, CB_SEND_CANCEL)
-                send_data.botm_choose_channel = context.bot.send_message_keyboard(chat_id=chat_id,
-                                                                                  text=answer,
-                                                                                  reply_markup=reply_markup,
-                                                                                  parse_mode=ParseMode.HTML)
+                send_data.botm_choose_channel = TelegramShoutoutBot.send_channel_keyboard(
+                    context, chat_id, answer, accessible_channels, CB_SEND_CANCEL, parse_mode=ParseMode.HTML)
                 return SEND_CHANNEL
             else:
                 answer = "Du benötigst Admin-Rechte um Nachrichten zu verschicken."
@@ -223,35 +283,51 @@ class TelegramShoutoutBot:
     def answer_channel(self, update: Update, context: CallbackContext):
         self.remove_all_inline_keyboards(update, context)
         chat_id = update.effective_chat.id
+        send_data = context.user_data["send"]  # type: SendData
         with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
             user = session.get_user_by_chat_id(chat_id)
-            channel = self.get_channel_from_update(session, update, context)
+            channels = self.get_channels_from_update(session, update, context)
             if user is None:
                 context.bot.send_message(chat_id=chat_id, text=self.get_message_user_not_known())
                 return ConversationHandler.END
-            elif channel is None:
+            elif None in channels:
                 answer = "Kanal nicht vorhanden. Bitte anderen Kanal eingeben."
                 context.bot.send_message(chat_id=chat_id, text=answer)
                 # no return statement (stay in same state)
             else:
-                if channel.ldap_filter is None or len(channel.ldap_filter) == 0:
-                    logger.warning("No LDAP filter configured for channel {0}. Denying access.".format(channel.name))
-                if self.ldap_access.check_filter(user.ldap_account, channel.ldap_filter):
-                    send_data = context.user_data["send"]
-                    send_data.channel = channel.name
+                denied_channels = self.get_denied_channels(session, user, channels)
+                if len(denied_channels) == 0:
+                    for channel in channels:
+                        if channel.name not in send_data.channels:
+                            send_data.channels.append(channel.name)
                     updated_text = "<b>Nachricht senden</b>\n\n" \
-                                   "Ausgewählter Kanal: <b>" + channel.name + "</b>"
+                                   "Ausgewählte Kanäle: <b>" + ", ".join(send_data.channels) + "</b>"
                     send_data.botm_choose_channel.result(10).edit_text(text=updated_text, parse_mode=ParseMode.HTML)
-                    answer = "Nachrichten eingeben, die gesendet werden soll."
-                    context.bot.send_message(chat_id=chat_id, text=answer)
-                    return SEND_MESSAGE
+                    answer = "Du kannst weitere Kanäle auswählen oder mit der Eingabe der Nachrichten fortfahren."
+                    remaining_channels = [channel for channel in self.get_accessible_channels(session, user)
+                                          if channel.name not in send_data.channels]
+                    TelegramShoutoutBot.send_channel_keyboard(context, chat_id, answer, remaining_channels,
+                                                              CB_SEND_CANCEL, CB_SEND_CHANNELS_DONE)
+                    # no return statement (stay in same state)
                 else:
-                    answer = "Du hast keine Berechtigung an diesen Kanal zu schreiben."
+                    answer = "Du hast keine Berechtigung an die folgenden Kanäle zu schreiben: " + \
+                             ", ".join(channel.name for channel in denied_channels)
                     all_channels = session.get_channels()
-                    reply_markup = TelegramShoutoutBot.create_channel_keyboard(all_channels, CB_SEND_CANCEL)
-                    context.bot.send_message_keyboard(chat_id=chat_id, text=answer, reply_markup=reply_markup)
+                    TelegramShoutoutBot.send_channel_keyboard(context, chat_id, answer, all_channels, CB_SEND_CANCEL)
                     # no return statement (stay in same state)
 
+    def answer_channels_done(self, update: Update, context: CallbackContext):
+        self.remove_all_inline_keyboards(update, context)
+        chat_id = update.effective_chat.id
+        send_data = context.user_data["send"]  # type: SendData
+        if len(send_data.channels) < 1:
+            answer = "Bitte mindestens einen Kanal eingeben oder Abbrechen mit /cancel."
+            context.bot.send_message(chat_id=chat_id, text=answer)
+            return None
+        answer = "Nachrichten eingeben, die gesendet werden soll."
+        context.bot.send_message(chat_id=chat_id, text=answer)
+        return SEND_MESSAGE
+
     def answer_message(self, update: Update, context: CallbackContext):
         self.remove_all_inline_keyboards(update, context)
         chat_id = update.effective_chat.id
@@ -288,12 +364,21 @@ class TelegramShoutoutBot:
         if send_data.botm_add_messages is not None:
             send_data.botm_add_messages.result(10).delete()
             send_data.botm_add_messages = None
+        # Dry run to show the admin what the broadcast will cost
+        with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
+            channels = session.get_channels_by_names(send_data.channels)
+            dry_run = broadcast.dry_run(session, channels, send_data.messages)
         # Send saved data to user
         answer = "Die folgenden Nachrichten sind gespeichert und werden versendet:\n" \
-                 "Ziel-Kanalname: <b>{0}</b>".format(send_data.channel)
+                 "Ziel-Kanäle: <b>{0}</b>\n" \
+                 "Abonnenten: <b>{1}</b>\n" \
+                 "API-Aufrufe insgesamt: <b>{2}</b> ({3})\n" \
+                 "Geschätzte Versanddauer: <b>{4}</b>"\
+            .format(", ".join(send_data.channels), dry_run.recipients, dry_run.total_calls,
+                    ", ".join("{0}: {1}".format(method, count) for method, count in dry_run.calls_by_method().items()),
+                    TelegramShoutoutBot.format_duration(dry_run.estimated_seconds))
         context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
-        for message in send_data.messages:  # type: Message
-            TelegramShoutoutBot.resend_message(update.effective_chat.id, message, context)
+        TelegramShoutoutBot.resend_messages(update.effective_chat.id, send_data.messages, context)
 
         # Message asking for confirmation
         answer = "Bitte Versand bestätigen:"
@@ -311,44 +396,164 @@ class TelegramShoutoutBot:
         send_data = context.user_data["send"]  # type: SendData
         updated_text = "Nachrichten werden versendet"
         send_data.botm_confirmation.result(10).edit_text(text=updated_text, parse_mode=ParseMode.HTML)
-        channel_name = send_data.channel
-        log_messages_strings = list(map(lambda msg: msg.__dict__, send_data.messages))
-        log_message_format = "Sent message by user {0} ({1}, {2} {3}) to channel {4}: {5}"
-        adminLogger.info(log_message_format.format(chat.id, chat.username, chat.first_name,
-                                                   chat.last_name, channel_name, log_messages_strings))
+        channel_names = send_data.channels
+        self.admin_logger.info("Sent message by user {0} to channels {1}".format(chat.id, ", ".join(channel_names)),
+                               extra={'chat_id': chat.id, 'username': chat.username, 'first_name': chat.first_name,
+                                      'last_name': chat.last_name, 'channels': channel_names,
+                                      'messages': list(map(TelegramShoutoutBot.describe_message, send_data.messages))})
         with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
             # Verify permissions again to be safe (the conversation could be running for longer)
             user = session.get_user_by_chat_id(chat.id)
-            channel = session.get_channel_by_name(channel_name)
-            if user is None or user.ldap_account is None or not self.ldap_access.check_usergroup(user.ldap_account) or \
-                    not self.ldap_access.check_filter(user.ldap_account, channel.ldap_filter):
-                adminLogger.warning("Stopped message sending because of insufficient permissions.")
+            channels = session.get_channels_by_names(channel_names)
+            if user is None or len(channels) != len(channel_names) or not self.is_admin(session, user) or \
+                    len(self.get_denied_channels(session, user, channels)) > 0:
+                self.admin_logger.warning("Stopped message sending because of insufficient permissions.")
                 answer = "Du hast keine Berechtigung zum Nachrichtenversand."
                 context.bot.send_message(chat_id=chat.id, text=answer)
                 return ConversationHandler.END
-            # Send message out to users
-            subscriber_count = 0
-            last_message = None
-            for user in session.get_users():
-                if channel_name in user.channels:
-                    subscriber_count += 1
-                    for message in send_data.messages:
-                        last_message = TelegramShoutoutBot.resend_message(user.chat_id, message, context)
-
-            if last_message is not None:
-                promise_result = last_message.result(60)
-                message_counter = len(send_data.messages) * subscriber_count
-                if promise_result is not None:
-                    answer = "Nachrichten erfolgreich zugestellt. " \
-                             "Es wurden insgesamt <b>{0}</b> Nachrichten an <b>{1}</b> Abonnenten versendet."
-                else:
-                    answer = "Nicht alle Nachrichten konnten innerhalb von 60 Sekunden zugestellt werden. " \
-                             "Es sollten insgesamt <b>{0}</b> an <b>{1}</b> Abonnenten Nachrichten versendet werden."
-                context.bot.send_message(chat_id=chat.id, text=answer.format(message_counter, subscriber_count),
-                                         parse_mode=ParseMode.HTML)
-                adminLogger.info(answer)
+            # Only once to users that subscribed several of the channels. Read before anything is written in the
+            # session, as the session reads from the primary database afterwards.
+            subscriber_chat_ids = session.get_subscriber_chat_ids([channel.id for channel in channels])
+            # The message ids are stored, so that the broadcast can be edited or deleted later
+            broadcast_id = session.add_broadcast(chat.id, channel_names,
+                                                 [TelegramShoutoutBot.describe_message(message)['type']
+                                                  for message in send_data.messages]).id
+        # Sending runs in the background, limited by the admission control
+        position = self.broadcast_admission.submit(self.run_broadcast, context, chat.id, broadcast_id, channel_names,
+                                                   send_data.messages, subscriber_chat_ids,
+                                                   on_error=lambda error: self.broadcast_failed(context, chat.id,
+                                                                                                broadcast_id, error))
+        if position > 0:
+            answer = "Der Bot versendet gerade andere Nachrichten. " \
+                     "Dein Versand ist in der Warteschlange auf Position <b>{0}</b> " \
+                     "und startet automatisch.".format(position)
+            context.bot.send_message(chat_id=chat.id, text=answer, parse_mode=ParseMode.HTML)
+            self.admin_logger.info("Broadcast {0} queued at position {1}".format(broadcast_id, position),
+                                   extra={'bot': self.config.name, 'chat_id': chat.id, 'broadcast_id': broadcast_id,
+                                          'position': position})
+        return ConversationHandler.END
+
+    def run_broadcast(self, window: admission.SendWindow, context: CallbackContext, sender_chat_id, broadcast_id,
+                      channel_names: List[str], messages: List[Message], subscriber_chat_ids: List[int]):
+        """Sends the messages to the subscribers (called by the admission control in a background thread)."""
+        unit_sizes = [len(unit) for unit in broadcast.group_messages(messages)]
+        recorder = self.broadcast_jobs.recorder(broadcast_id, unit_sizes)
+        window.on_done = recorder.add
+        try:
+            for subscriber_chat_id in subscriber_chat_ids:
+                window.add(subscriber_chat_id,
+                           TelegramShoutoutBot.resend_messages(subscriber_chat_id, messages, context))
+            window.finish()
+        finally:
+            # Edit and recall are possible from now on (for the recorded recipients if sending failed)
+            recorder.flush()
+            with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
+                session.finish_broadcast_sending(broadcast_id)
+
+        subscriber_count = len(subscriber_chat_ids)
+        message_counter = len(messages) * subscriber_count
+        if recorder.failures == 0:
+            answer = "Nachrichten erfolgreich zugestellt. " \
+                     "Es wurden insgesamt <b>{0}</b> Nachrichten an <b>{1}</b> Abonnenten versendet."
+        else:
+            answer = "Nicht alle Nachrichten konnten zugestellt werden. " \
+                     "Von insgesamt <b>{0}</b> Nachrichten an <b>{1}</b> Abonnenten sind <b>{3}</b> fehlgeschlagen."
+        answer += "\nVersand-Nummer: <b>{2}</b> (für /edit und /recall)"
+        answer = answer.format(message_counter, subscriber_count, broadcast_id, recorder.failures)
+        context.bot.send_message(chat_id=sender_chat_id, text=answer, parse_mode=ParseMode.HTML)
+        self.admin_logger.info(answer, extra={'bot': self.config.name, 'chat_id': sender_chat_id,
+                                              'channels': channel_names, 'broadcast_id': broadcast_id,
+                                              'message_count': message_counter, 'subscriber_count': subscriber_count,
+                                              'failures': recorder.failures})
+
+    def broadcast_failed(self, context: CallbackContext, sender_chat_id, broadcast_id, error: Exception):
+        """Informs the sender and the developers about a broadcast that failed (the error is logged already)."""
+        answer = "Beim Versand {0} ist ein Fehler aufgetreten. Die Nachrichten wurden möglicherweise nicht an alle " \
+                 "Abonnenten zugestellt.".format(broadcast_id)
+        context.bot.send_message(chat_id=sender_chat_id, text=answer)
+        self.admin_logger.error("Broadcast {0} failed: {1}".format(broadcast_id, error),
+                                extra={'bot': self.config.name, 'chat_id': sender_chat_id,
+                                       'broadcast_id': broadcast_id})
+        for dev_id in self.config.bot_devs:
+            context.bot.send_message(dev_id, "An error occured in the bot and was logged.")
+
+    # Starting here: Functions for editing and deleting sent broadcasts
+    def cmd_broadcasts(self, update: Update, context: CallbackContext):
+        self.remove_all_inline_keyboards(update, context)
+        chat_id = update.effective_chat.id
+        with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
+            broadcasts = session.get_broadcasts_by_sender(chat_id, 10)
+            if len(broadcasts) == 0:
+                answer = "Du hast noch keine Nachrichten versendet."
+            else:
+                answer = "<b>Deine letzten Versände:</b>\n"
+                for sent_broadcast in broadcasts:
+                    answer += "&#8226; <b>{0}</b> - {1} an {2}".format(
+                        sent_broadcast.id, time.strftime("%d.%m.%Y %H:%M", time.localtime(sent_broadcast.time_sent)),
+                        sent_broadcast.channels.replace(",", ", "))
+                    if not sent_broadcast.sending_done:
+                        answer += " (wird versendet)"
+                    elif sent_broadcast.job is not None:
+                        answer += " ({0}: {1})".format(sent_broadcast.job, sent_broadcast.job_state)
+                    answer += "\n"
+                answer += "\nMit /edit &lt;Nummer&gt; &lt;Text&gt; kann der Text der ersten Nachricht geändert, " \
+                          "mit /recall &lt;Nummer&gt; können die Nachrichten gelöscht werden."
+        context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
+
+    def cmd_edit(self, update: Update, context: CallbackContext):
+        self.remove_all_inline_keyboards(update, context)
+        chat_id = update.effective_chat.id
+        # The new text is everything after the broadcast number (keeping the formatting of the message)
+        parts = update.message.text_html.split(None, 2)
+        if len(parts) < 3 or not parts[1].isdigit():
+            context.bot.send_message(chat_id=chat_id, text="Verwendung: /edit <Nummer> <neuer Text>")
+            return
+        with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
+            sent_broadcast = self.get_own_broadcast(session, update, context, int(parts[1]))
+            if sent_broadcast is None:
+                return
+            if sent_broadcast.message_types.split(",")[0] not in broadcast_jobs.EDITABLE_TYPES:
+                answer = "Die erste Nachricht dieses Versands kann nicht bearbeitet werden."
+                context.bot.send_message(chat_id=chat_id, text=answer)
+                return
+        self.broadcast_jobs.start(int(parts[1]), broadcast_jobs.JOB_EDIT, chat_id, parts[2])
+        self.admin_logger.info("User {0} edits broadcast {1}".format(chat_id, parts[1]),
+                               extra={'chat_id': chat_id, 'broadcast_id': int(parts[1]), 'text': parts[2]})
+        context.bot.send_message(chat_id=chat_id, text="Die Nachrichten werden jetzt bearbeitet.")
 
-            return ConversationHandler.END
+    def cmd_recall(self, update: Update, context: CallbackContext):
+        self.remove_all_inline_keyboards(update, context)
+        chat_id = update.effective_chat.id
+        if len(context.args) != 1 or not context.args[0].isdigit():
+            context.bot.send_message(chat_id=chat_id, text="Verwendung: /recall <Nummer>")
+            return
+        broadcast_id = int(context.args[0])
+        with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
+            if self.get_own_broadcast(session, update, context, broadcast_id) is None:
+                return
+        self.broadcast_jobs.start(broadcast_id, broadcast_jobs.JOB_DELETE, chat_id)
+        self.admin_logger.info("User {0} recalls broadcast {1}".format(chat_id, broadcast_id),
+                               extra={'chat_id': chat_id, 'broadcast_id': broadcast_id})
+        context.bot.send_message(chat_id=chat_id, text="Die Nachrichten werden jetzt gelöscht.")
+
+    def get_own_broadcast(self, session: MyDatabaseSession, update: Update, context: CallbackContext,
+                          broadcast_id: int):
+        """Returns the broadcast if the user sent it and still has admin rights, otherwise answers with an error."""
+        chat_id = update.effective_chat.id
+        user = session.get_user_by_chat_id(chat_id)
+        sent_broadcast = session.get_broadcast(broadcast_id)
+        if user is None or not self.is_admin(session, user):
+            answer = "Du benötigst Admin-Rechte um Nachrichten zu bearbeiten."
+        elif sent_broadcast is None or sent_broadcast.sender_chat_id != chat_id:
+            answer = "Du hast keinen Versand mit dieser Nummer verschickt."
+        elif not sent_broadcast.sending_done:
+            answer = "Dieser Versand wird noch verschickt. Er kann erst danach bearbeitet oder gelöscht werden."
+        elif sent_broadcast.job_state == broadcast_jobs.STATE_RUNNING:
+            answer = "Für diesen Versand läuft bereits eine Änderung."
+        else:
+            return sent_broadcast
+        context.bot.send_message(chat_id=chat_id, text=answer)
+        return None
 
     def cancel_send(self, update: Update, context: CallbackContext):
         self.remove_all_inline_keyboards(update, context)
@@ -367,7 +572,7 @@ class TelegramShoutoutBot:
                 context.bot.send_message(chat_id=chat_id, text=self.get_message_user_not_known())
                 return ConversationHandler.END
             else:
-                subscribed_channels = user.channels.values()
+                subscribed_channels = session.get_subscribed_channels(user)
                 unsubscribed_channels = session.get_unsubscribed_channels(chat_id)
                 answer = "<b>Kanal abonnieren</b>\n\n" \
                          "Kanal eingeben, der abonniert werden soll oder Abbrechen mit /cancel.\n\n" \
@@ -375,9 +580,8 @@ class TelegramShoutoutBot:
                          TelegramShoutoutBot.create_channel_list(subscribed_channels) + \
                          "\n<b>Verfügbare Kanäle:</b>\n" + \
                          TelegramShoutoutBot.create_channel_list(unsubscribed_channels)
-                reply_markup = TelegramShoutoutBot.create_channel_keyboard(unsubscribed_channels, CB_SUBSCRIBE_CANCEL)
-                context.bot.send_message_keyboard(chat_id=chat_id, text=answer, reply_markup=reply_markup,
-                                                  parse_mode=ParseMode.HTML)
+                TelegramShoutoutBot.send_channel_keyboard(context, chat_id, answer, unsubscribed_channels,
+                                                          CB_SUBSCRIBE_CANCEL, parse_mode=ParseMode.HTML)
                 return SUBSCRIBE_CHANNEL
 
     def answer_subscribe_channel(self, update: Update, context: CallbackContext):
@@ -390,21 +594,21 @@ class TelegramShoutoutBot:
                 context.bot.send_message(chat_id=chat_id, text=self.get_message_user_not_known())
                 return ConversationHandler.END
             elif channel is not None:
-                if channel.name in user.channels:
+                if channel.id in user.channels:
                     answer = "Du hast diesen Kanal bereits abonniert."
                     context.bot.send_message(chat_id=chat_id, text=answer)
                     return ConversationHandler.END
                 else:
                     session.add_channel(chat_id, channel)
-                    userLogger.info("User {0} subscribed channel {1}.".format(chat_id, channel.name))
+                    self.user_logger.info("User {0} subscribed channel {1}.".format(chat_id, channel.name))
                     answer = "Kanal <b>" + channel.name + "</b> wurde abonniert."
                     context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
                     return ConversationHandler.END
             else:
                 answer = "Kanal nicht vorhanden. Bitte anderen Kanal eingeben."
                 unsubscribed_channels = session.get_unsubscribed_channels(chat_id)
-                reply_markup = TelegramShoutoutBot.create_channel_keyboard(unsubscribed_channels, CB_SUBSCRIBE_CANCEL)
-                context.bot.send_message_keyboard(chat_id=chat_id, text=answer, reply_markup=reply_markup)
+                TelegramShoutoutBot.send_channel_keyboard(context, chat_id, answer, unsubscribed_channels,
+                                                          CB_SUBSCRIBE_CANCEL)
                 # no return statement (stay in same state)
 
     def cancel_subscribe(self, update: Update, context: CallbackContext):
@@ -424,14 +628,14 @@ class TelegramShoutoutBot:
                 return ConversationHandler.END
             else:
                 # Filter out mandatory channels from list to select from
-                subscribed_channels = list(filter(lambda channel: not channel.mandatory, user.channels.values()))
+                subscribed_channels = list(filter(lambda channel: not channel.mandatory,
+                                                  session.get_subscribed_channels(user)))
                 answer = "<b>Kanal deabonnieren</b>\n\n"\
                          "Kanal eingeben, der deabonniert werden soll oder Abbrechen mit /cancel.\n\n" \
                          "<b>Bereits abonnierte Kanäle:</b>\n" + \
                          TelegramShoutoutBot.create_channel_list(subscribed_channels)
-                reply_markup = TelegramShoutoutBot.create_channel_keyboard(subscribed_channels, CB_UNSUBSCRIBE_CANCEL)
-                context.bot.send_message_keyboard(chat_id=chat_id, text=answer, reply_markup=reply_markup,
-                                                  parse_mode=ParseMode.HTML)
+                TelegramShoutoutBot.send_channel_keyboard(context, chat_id, answer, subscribed_channels,
+                                                          CB_UNSUBSCRIBE_CANCEL, parse_mode=ParseMode.HTML)
                 return UNSUBSCRIBE_CHANNEL
 
     def answer_unsubscribe_channel(self, update: Update, context: CallbackContext):
@@ -448,7 +652,7 @@ class TelegramShoutoutBot:
                          "Bitte anderen Kanal eingeben oder Abbrechen mit /cancel."
                 context.bot.send_message(chat_id=chat_id, text=answer)
                 # no return statement (stay in same state)
-            elif channel not in user.channels.values():
+            elif channel.id not in user.channels:
                 answer = "Kanal nicht abonniert. " \
                          "Bitte anderen Kanal eingeben oder Abbrechen mit /cancel."
                 context.bot.send_message(chat_id=chat_id, text=answer)
@@ -459,7 +663,7 @@ class TelegramShoutoutBot:
                 # no return statement (stay in same state)
             else:
                 session.remove_channel(chat_id, channel)
-                userLogger.info("User {0} desubscribed channel {1}.".format(chat_id, channel.name))
+                self.user_logger.info("User {0} desubscribed channel {1}.".format(chat_id, channel.name))
                 answer = "Kanal <b>" + channel.name + "</b> wurde deabonniert."
                 context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
                 return ConversationHandler.END
@@ -491,8 +695,7 @@ class TelegramShoutoutBot:
                  "Benutze /help für eine Liste der vefügbaren Kommandos."
         context.bot.send_message(chat_id=update.effective_chat.id, text=answer)
 
-    @staticmethod
-    def error(update: Update, context: CallbackContext):
+    def error(self, update: Update, context: CallbackContext):
         """Log Errors caused by Updates."""
         # we want to notify the user of this problem. This will always work, but not notify users if the update is an
         # callback or inline query, or a poll update. In case you want this, keep in mind that sending the message
@@ -522,10 +725,14 @@ class TelegramShoutoutBot:
         text = "Hey.\n The error <code>{0}</code> happened{1}. The full traceback:\n\n<code>{2}" \
                "</code>".format(context.error, payload, trace)
         # and send it to the dev(s)
-        for dev_id in Conf.bot_devs:
+        for dev_id in self.config.bot_devs:
             context.bot.send_message(dev_id, "An error occured in the bot and was logged.")
         # we raise the error again, so the logger module catches it. If you don't use the logger module, use it.
-        logger.warning('Update "%s" caused error "%s".\nFull information: %s', update, context.error, text)
+        # Network errors can occur in large numbers (e.g., during a broadcast), so those are only sampled.
+        logger.warning('Update "%s" caused error "%s".\nFull information: %s', update, context.error, text,
+                       extra={'bot': self.config.name, 'update_id': update.update_id if update else None,
+                              'error_type': type(context.error).__name__,
+                              'sampled': isinstance(context.error, telegram.error.NetworkError)})
 
     @staticmethod
     def message_valid(message: Message):
@@ -534,6 +741,50 @@ class TelegramShoutoutBot:
         else:
             return False
 
+    @staticmethod
+    def describe_message(message: Message) -> dict:
+        """Fields of a message worth logging (instead of dumping the whole object)."""
+        if message.text:
+            message_type = 'text'
+        elif message.photo:
+            message_type = 'photo'
+        elif message.sticker:
+            message_type = 'sticker'
+        elif message.video:
+            message_type = 'video'
+        else:
+            message_type = 'other'
+        return {'message_id': message.message_id,
+                'type': message_type,
+                'text': message.text_html if message.text else message.caption}
+
+    @staticmethod
+    def resend_messages(chat_id, messages: List[Message], context: CallbackContext):
+        """Sends the messages to the chat (photos and videos of the same album as one album) and returns the promises
+        (one for each unit returned by broadcast.group_messages)."""
+        promises = []
+        for unit in broadcast.group_messages(messages):
+            if len(unit) > 1:
+                promises.append(TelegramShoutoutBot.resend_album(chat_id, unit, context))
+            else:
+                promises.append(TelegramShoutoutBot.resend_message(chat_id, unit[0], context))
+        return promises
+
+    @staticmethod
+    def resend_album(chat_id, messages: List[Message], context: CallbackContext):
+        media = []
+        for message in messages:
+            if message.photo:
+                media.append(InputMediaPhoto(media=message.photo[-1].file_id,
+                                             caption=message.caption_html,
+                                             parse_mode=ParseMode.HTML))
+            else:
+                media.append(InputMediaVideo(media=message.video.file_id,
+                                             caption=message.caption_html,
+                                             duration=message.video.duration,
+                                             parse_mode=ParseMode.HTML))
+        return context.bot.send_media_group(chat_id=chat_id, media=media)
+
     @staticmethod
     def resend_message(chat_id, message: Message, context: CallbackContext):
         # The following case distinction is similar to the one in
@@ -571,46 +822,119 @@ class TelegramShoutoutBot:
         # Not handled so far: voice, document, audio, contact, venue, location, video_note, game
 
     @staticmethod
-    def create_channel_list(channels: Iterable[Channel]) -> str:
-        answer = ""
-        for channel in channels:
-            answer += "&#8226; <b>{0}</b> - {1}\n".format(channel.name, channel.description)
+    def format_duration(seconds: float) -> str:
+        minutes, seconds = divmod(int(round(seconds)), 60)
+        if minutes > 0:
+            return "{0} min {1} s".format(minutes, seconds)
+        return "{0} s".format(seconds)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def create_help_text() -> str:
+        answer = "<b>Verfügbare Kommandos:</b>\n"
+        answer += "".join("/{0} - {1}\n".format(key, val) for key, val in GENERAL_COMMANDS.items())
+        answer += "\n<b>Befehle für Administratoren:</b>\n"
+        answer += "".join("/{0} - {1}\n".format(key, val) for key, val in ADMIN_COMMANDS.items())
         return answer
 
+    # The rendered channel lists and keyboards are cached by the shown channels. Only the subscriber counters change
+    # frequently, they are not part of the key but filled into the cached list template.
+    @staticmethod
+    def create_channel_list(channels: Iterable[Channel]) -> str:
+        channels = list(channels)
+        template = TelegramShoutoutBot.channel_list_cache.get(
+            tuple((channel.id, channel.name, channel.description) for channel in channels),
+            lambda: TelegramShoutoutBot.render_channel_list_template(channels))
+        return template.format(*(channel.subscriber_count for channel in channels))
+
+    @staticmethod
+    def render_channel_list_template(channels: List[Channel]) -> str:
+        def escape_braces(text) -> str:
+            return str(text).replace("{", "{{").replace("}", "}}")
+
+        return "".join("&#8226; <b>{0}</b> - {1} ({{{2}}} Abonnenten)\n"
+                       .format(escape_braces(channel.name), escape_braces(channel.description), index)
+                       for index, channel in enumerate(channels))
+
+    @staticmethod
+    def render_channel_keyboard(keyboard: tuple, page: int = 0) -> InlineKeyboardMarkup:
+        """Returns the given page of a keyboard stored by send_channel_keyboard."""
+        entries, cancel_callback_data, done_callback_data = keyboard
+        page_count = max(1, (len(entries) + CHANNEL_KEYBOARD_PAGE_SIZE - 1) // CHANNEL_KEYBOARD_PAGE_SIZE)
+        page = min(page, page_count - 1)
+        return TelegramShoutoutBot.channel_keyboard_cache.get(
+            keyboard + (page,),
+            lambda: TelegramShoutoutBot.build_channel_keyboard(entries, cancel_callback_data, done_callback_data, page,
+                                                               page_count))
+
     @staticmethod
-    def create_channel_keyboard(channels: Iterable[Channel], cancel_callback_data: str) -> InlineKeyboardMarkup:
+    def build_channel_keyboard(entries: Tuple[Tuple[int, str, str], ...], cancel_callback_data: str,
+                               done_callback_data: str, page: int, page_count: int) -> InlineKeyboardMarkup:
         keyboard = []
-        for channel in channels:
-            button_text = "{0} - {1}\n".format(channel.name, channel.description)
-            callback_data = CB_CHANNEL_PREFIX + str(channel.id)
+        first = page * CHANNEL_KEYBOARD_PAGE_SIZE
+        for channel_id, name, description in entries[first:first + CHANNEL_KEYBOARD_PAGE_SIZE]:
+            button_text = "{0} - {1}\n".format(name, description)
+            callback_data = CB_CHANNEL_PREFIX + str(channel_id)
             keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
+        if page_count > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("« Zurück", callback_data=CB_PAGE_PREFIX + str(page - 1)))
+            if page < page_count - 1:
+                navigation.append(InlineKeyboardButton("Mehr »", callback_data=CB_PAGE_PREFIX + str(page + 1)))
+            keyboard.append(navigation)
+        if done_callback_data is not None:
+            keyboard.append([InlineKeyboardButton("Weiter", callback_data=done_callback_data)])
         keyboard.append([InlineKeyboardButton("Abbrechen", callback_data=cancel_callback_data)])
         return InlineKeyboardMarkup(keyboard)
 
+    @staticmethod
+    def send_channel_keyboard(context: CallbackContext, chat_id, text: str, channels: Iterable[Channel],
+                              cancel_callback_data: str, done_callback_data: str = None, parse_mode: str = None):
+        """Sends the text with a keyboard for choosing a channel. The channels are stored in the user data, so that
+        answer_keyboard_page can show the other pages of the keyboard."""
+        keyboard = (tuple((channel.id, channel.name, channel.description) for channel in channels),
+                    cancel_callback_data, done_callback_data)
+        context.user_data["keyboard"] = keyboard
+        reply_markup = TelegramShoutoutBot.render_channel_keyboard(keyboard)
+        return context.bot.send_message_keyboard(chat_id=chat_id, text=text, reply_markup=reply_markup,
+                                                 parse_mode=parse_mode)
+
+    @staticmethod
+    def answer_keyboard_page(update: Update, context: CallbackContext):
+        # Only the buttons of the keyboard are exchanged, so the inline keyboards are not removed here
+        query = update.callback_query
+        keyboard = context.user_data.get("keyboard")
+        if keyboard is not None:
+            reply_markup = TelegramShoutoutBot.render_channel_keyboard(keyboard, int(context.match.group(1)))
+            context.bot.edit_message_reply_markup(chat_id=query.message.chat_id, message_id=query.message.message_id,
+                                                  reply_markup=reply_markup)
+        # no return statement (stay in same state)
+
     @staticmethod
     def get_message_user_not_known() -> str:
         return "Dein Telegram-Account ist nicht bekannt. " \
                "Um mit dem Bot zu kommunizieren, musst du zunächst /start eingeben."
 
     def remove_all_inline_keyboards(self, update: Update, context: CallbackContext):
-        # Read all items from the queue
-        while True:
-            try:
-                (item_chat_id, item_msg_id) = self.keyboard_message_queue.get(block=False)
-                if item_chat_id not in self.keyboard_message_user_lists:
-                    self.keyboard_message_user_lists[item_chat_id] = []
-                self.keyboard_message_user_lists[item_chat_id].append(item_msg_id)
-            except Empty:
-                break
-
-        # Check list for the active user if there are keyboards to delete
         chat_id = update.effective_chat.id
-        if chat_id in self.keyboard_message_user_lists:
-            for msg_id in self.keyboard_message_user_lists[chat_id]:
-                context.bot.edit_message_reply_markup(chat_id=chat_id,
-                                                      message_id=msg_id,
-                                                      reply_markup=None)
-            del self.keyboard_message_user_lists[chat_id]
+        with self.keyboard_message_lock:
+            # Read all items from the queue
+            while True:
+                try:
+                    (item_chat_id, item_msg_id) = self.keyboard_message_queue.get(block=False)
+                    if item_chat_id not in self.keyboard_message_user_lists:
+                        self.keyboard_message_user_lists[item_chat_id] = []
+                    self.keyboard_message_user_lists[item_chat_id].append(item_msg_id)
+                except Empty:
+                    break
+            # Check list for the active user if there are keyboards to delete
+            msg_ids = self.keyboard_message_user_lists.pop(chat_id, [])
+
+        for msg_id in msg_ids:
+            context.bot.edit_message_reply_markup(chat_id=chat_id,
+                                                  message_id=msg_id,
+                                                  reply_markup=None)
 
     @staticmethod
     def get_channel_from_update(session: MyDatabaseSession, update: Update, context: CallbackContext):
@@ -622,31 +946,268 @@ class TelegramShoutoutBot:
             requested_channel_id = int(context.match.group(1))
             return session.get_channel_by_id(requested_channel_id)
 
+    @staticmethod
+    def get_channels_from_update(session: MyDatabaseSession, update: Update, context: CallbackContext) \
+            -> List[Channel]:
+        """Like get_channel_from_update, but allows several comma-separated channel names in text messages.
+
+        Channels that do not exist are returned as None.
+        """
+        if update.message:
+            requested_channels = [name.strip() for name in update.message.text.split(",") if name.strip() != ""]
+            channels = {channel.name.lower(): channel for channel in session.get_channels_by_names(requested_channels)}
+            return [channels.get(name.lower()) for name in requested_channels]
+        else:
+            return [TelegramShoutoutBot.get_channel_from_update(session, update, context)]
+
+    # The permissions are read from the snapshot maintained by permissions.PermissionSync (no LDAP queries)
+    def is_admin(self, session: MyDatabaseSession, user: User) -> bool:
+        permission = self.permission_sync.get_permission(session, user)
+        return permission is not None and permission.admin
+
+    def get_denied_channels(self, session: MyDatabaseSession, user: User, channels: List[Channel]) -> List[Channel]:
+        permission = self.permission_sync.get_permission(session, user)
+        allowed_ids = permission.get_channel_ids() if permission is not None else set()
+        return [channel for channel in channels if channel.id not in allowed_ids]
+
     def get_accessible_channels(self, session: MyDatabaseSession, user: User) -> List[Channel]:
-        all_channels: List[Channel] = session.get_channels()
-        predicate: Callable[[Channel], bool] = lambda channel: self.ldap_access.check_filter(user.ldap_account,
-                                                                                             channel.ldap_filter)
-        return list(filter(predicate, all_channels))
+        permission = self.permission_sync.get_permission(session, user)
+        allowed_ids = permission.get_channel_ids() if permission is not None else set()
+        return [channel for channel in session.get_channels() if channel.id in allowed_ids]
 
-    def __init__(self):
-        from telegram.utils.request import Request
+    def cmd_refresh(self, update: Update, context: CallbackContext):
+        self.remove_all_inline_keyboards(update, context)
+        chat_id = update.effective_chat.id
+        if chat_id in self.config.bot_devs:
+            # Developers refresh the permissions of all users (in the background, it can take a while)
+            threading.Thread(target=self.permission_sync.sync, name='permission_sync_refresh', daemon=True).start()
+            answer = "Die Berechtigungen aller Nutzer werden neu geladen."
+            context.bot.send_message(chat_id=chat_id, text=answer)
+            return
+        with my_session_scope(self.my_database) as session:  # type: MyDatabaseSession
+            user = session.get_user_by_chat_id(chat_id)
+            if user is None:
+                answer = self.get_message_user_not_known()
+            elif user.ldap_account is None:
+                answer = "Du hast <i>keinen</i> DPSG-Account mit deinem Telegram-Zugang verbunden."
+            else:
+                permission = self.permission_sync.sync_user(session, user)
+                answer = "Deine Berechtigungen wurden neu geladen. Mit /admin siehst du deinen aktuellen Status."
+                self.user_logger.info("User {0} refreshed the permissions.".format(chat_id),
+                                      extra={'chat_id': chat_id, 'admin': permission.admin})
+            context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
+
+    def cmd_status(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        if chat_id not in self.config.bot_devs:
+            TelegramShoutoutBot.answer_invalid_cmd(update, context)
+            return
+        answer = "<b>Startzeiten:</b>\n" if self.config.name == '' else \
+            "<b>Bot {0}</b>\n\n<b>Startzeiten:</b>\n".format(html.escape(self.config.name))
+        for phase, duration in self.startup_timer.phases.items():
+            answer += "{0}: {1:.3f} s\n".format(phase, duration)
+        answer += "\n<b>Abhängigkeiten:</b>\n"
+        for dependency in self.get_dependencies():
+            answer += "{0}: {1}".format(dependency.name, dependency.status)
+            if dependency.duration is not None:
+                answer += " ({0:.3f} s)".format(dependency.duration)
+            if dependency.error is not None:
+                answer += " - {0}".format(html.escape(str(dependency.error)))
+            answer += "\n"
+        wait = self.worker_pool.wait_metrics.snapshot()
+        answer += "\n<b>Worker:</b>\n" \
+                  "Ausstehende Updates: {0}\n" \
+                  "Wartezeit (Mittel/p95/max): {1:.3f} s / {2:.3f} s / {3:.3f} s\n"\
+            .format(self.worker_pool.pending, wait['mean'], wait['p95'], wait['max'])
+        answer += "\n<b>Versand:</b>\n" \
+                  "Laufend: {0} (max. {1})\n" \
+                  "Wartend: {2}\n"\
+            .format(self.broadcast_admission.running, self.broadcast_admission.max_concurrent,
+                    self.broadcast_admission.waiting)
+        context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
+
+    def process_update_ordered(self, dispatcher: telegram.ext.Dispatcher, update):
+        # Updates of different chats are processed concurrently, updates of the same chat in the order they were
+        # received, as the state of the conversation depends on that
+        chat_id = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+        # The worker threads are shared by all bots, the same chat can talk to several of them independently
+        self.worker_pool.submit((self.config.name, chat_id), self.profiler.run_update,
+                                lambda: TelegramShoutoutBot.describe_update(update),
+                                telegram.ext.Dispatcher.process_update, dispatcher, update)
+
+    @staticmethod
+    def describe_update(update) -> str:
+        """Short description of the update for the profiler (the command or the kind of the update)."""
+        if not isinstance(update, Update):
+            return type(update).__name__
+        if update.callback_query is not None:
+            # Only the prefix of the callback data, e.g., CH for all channel buttons
+            return "callback " + (update.callback_query.data or "").rstrip(string.digits)
+        if update.message is not None:
+            if update.message.text is not None and update.message.text.startswith('/'):
+                return update.message.text.split()[0].split('@')[0]
+            return "message"
+        return "other"
+
+    def cmd_backfill(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        if chat_id not in self.config.bot_devs:
+            TelegramShoutoutBot.answer_invalid_cmd(update, context)
+            return
+        # Optional comma-separated names of (default) channels that should be added as well
+        channel_names = [name.strip() for name in " ".join(context.args).split(",") if name.strip() != ""]
+
+        def backfill():
+            try:
+                result = maintenance.backfill_subscriptions(self.my_database, channel_names)
+            except Exception:
+                logger.exception("Backfill failed")
+                context.bot.send_message(chat_id=chat_id, text="Das Nachtragen ist fehlgeschlagen (siehe Log).")
+                return
+            answer = "<b>Abonnements nachgetragen</b> ({0:.1f} s)\n".format(result.duration)
+            for name, added in result.added.items():
+                answer += "{0}: {1} hinzugefügt\n".format(html.escape(name), added)
+            answer += "Verwaiste Abonnements gelöscht: {0}\n".format(result.removed)
+            answer += "Korrigierte Abonnentenzähler: {0}".format(result.reconciled)
+            context.bot.send_message(chat_id=chat_id, text=answer, parse_mode=ParseMode.HTML)
+            self.admin_logger.info("User {0} backfilled subscriptions".format(chat_id),
+                                   extra={'chat_id': chat_id, 'added': result.added, 'removed': result.removed,
+                                          'reconciled': result.reconciled})
 
-        self.my_database = db.MyDatabase(Conf.database_url)
+        threading.Thread(target=backfill, name='backfill', daemon=True).start()
+        answer = "Die Abonnements der Pflichtkanäle werden nachgetragen und die Abonnentenzähler neu berechnet."
+        context.bot.send_message(chat_id=chat_id, text=answer)
 
-        self.ldap_access = ldap.LdapAccess(Conf.ldap_server, Conf.ldap_user,
-                                           Conf.ldap_password, Conf.ldap_base_group_filter)
+    def cmd_profile(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        if chat_id not in self.config.bot_devs:
+            TelegramShoutoutBot.answer_invalid_cmd(update, context)
+            return
+        duration = 30
+        if len(context.args) > 0 and context.args[0].isdigit():
+            duration = min(int(context.args[0]), 600)
+
+        def send_report(report: str):
+            # The report is sent without formatting, it contains function names with angle brackets
+            context.bot.send_message(chat_id=chat_id, text=report[:4096])
+
+        if self.profiler.start(duration, send_report):
+            answer = "Profiling für {0} s gestartet. Die Auswertung folgt danach.".format(duration)
+        else:
+            answer = "Das Profiling läuft bereits."
+        context.bot.send_message(chat_id=chat_id, text=answer)
+
+    def get_dependencies(self) -> List[readiness.LazyInitializer]:
+        return [self.my_database.schema, self.ldap_access.connection, self.bot_api]
 
-        # recommended values for production: 29/1017
-        q = mq.MessageQueue(all_burst_limit=29, all_time_limit_ms=1017)
-        # set connection pool size for bot
-        request = Request(con_pool_size=8)
-        mqbot = MQBot(token=Conf.bot_token,
-                      request=request,
-                      mqueue=q,
-                      keyboard_message_queue=self.keyboard_message_queue)
-        updater = telegram.ext.updater.Updater(bot=mqbot, use_context=True)
-        dispatcher = updater.dispatcher
+    def start_polling(self):
+        """Waits until the Telegram Bot API is available, then starts polling for updates.
 
+        The updater needs the result of getMe, so it is retried (with growing delays) until it succeeds or the bot is
+        stopped. The state is reported by the bot_api dependency.
+        """
+        delay = 1
+        while True:
+            try:
+                self.bot_api.ensure()
+                break
+            except telegram.error.TelegramError as e:
+                logger.warning("Telegram Bot API not available for bot {0!r}, retrying in {1} s: {2}"
+                               .format(self.config.name, delay, e), extra={'bot': self.config.name})
+                if self.stopping.wait(delay):
+                    return
+                delay = min(delay * 2, BOT_API_RETRY_MAX_DELAY)
+        logger.info("Telegram Bot API available after {0:.3f} s".format(self.bot_api.duration),
+                    extra={'bot': self.config.name, 'dependency': self.bot_api.name,
+                           'duration': self.bot_api.duration})
+        with self.startup_timer.phase('polling'):
+            self.updater.start_polling()
+        # Continue jobs on sent broadcasts that were interrupted by a restart
+        self.broadcast_jobs.resume()
+
+    def __init__(self, ldap_access: ldap.LdapAccess = None, config: tenants.BotConfig = None,
+                 shared: SharedResources = None):
+        """Creates the bot with the given config (default: the main bot configured by Conf).
+
+        Bots served by the same process get the same shared resources. If none are given, the bot creates its own and
+        also starts and stops them.
+        """
+        self.config = config if config is not None else tenants.BotConfig()
+        self.owns_shared = shared is None
+        if shared is None:
+            shared = SharedResources(ldap_access)
+        self.shared = shared
+        self.startup_timer = readiness.StartupTimer()
+        self.startup_timer.phases.update(shared.startup_timer.phases)
+        self.my_database = shared.my_database.for_bot(self.config.name)
+        self.ldap_access = shared.ldap_access
+        self.permission_sync = shared.permission_sync
+        self.worker_pool = shared.worker_pool
+        self.profiler = shared.profiler
+        # Log for admin actions
+        self.admin_logger = log.create_logger(self.config.logger_name('admin'), self.config.admin_log)
+        # Log for user actions
+        self.user_logger = log.create_logger(self.config.logger_name('user'), self.config.user_log)
+        # We use the following queue to store chat ids and message ids of messages containing inline keyboards, so
+        # that those can be deleted when not needed anymore (as they could have unwanted side effects). This queue has
+        # to be thread-safe as it is filled by the asynchronous calls triggered by the message queue.
+        self.keyboard_message_queue = Queue()
+        # The message ids are stored in the following dictionary by user when they are read from the queue. Updates
+        # are processed by several worker threads, so the dictionary is protected by the following lock.
+        self.keyboard_message_user_lists = {}
+        self.keyboard_message_lock = threading.Lock()
+        # Set by stop(), ends waiting for the Telegram Bot API in start_polling()
+        self.stopping = threading.Event()
+
+        with self.startup_timer.phase('bot'):
+            # Every bot has its own message queue, as the rate limits of Telegram apply per bot
+            q = mq.MessageQueue(all_burst_limit=broadcast.MQ_ALL_BURST_LIMIT,
+                                all_time_limit_ms=broadcast.MQ_ALL_TIME_LIMIT_MS)
+            try:
+                mqbot = MQBot(token=self.config.bot_token,
+                              base_url=self.config.bot_api_url,
+                              request=shared.request,
+                              mqueue=q,
+                              keyboard_message_queue=self.keyboard_message_queue)
+            except telegram.error.InvalidToken:
+                # The threads of the message queue would keep the process alive
+                q.stop()
+                raise
+            self.bot_api = readiness.LazyInitializer('telegram', mqbot.get_me)
+            self.broadcast_jobs = broadcast_jobs.BroadcastJobs(self.my_database, mqbot)
+            self.broadcast_admission = admission.BroadcastAdmission(Conf.max_concurrent_broadcasts,
+                                                                    Conf.max_queued_messages, self.config.name)
+            self.updater = telegram.ext.updater.Updater(bot=mqbot, use_context=True)
+            dispatcher = self.updater.dispatcher
+
+        with self.startup_timer.phase('handlers'):
+            self.register_handlers(dispatcher)
+            # The update loop of the dispatcher calls process_update for every update, we hand them over to the pool
+            dispatcher.process_update = lambda update: self.process_update_ordered(dispatcher, update)
+
+    def start(self):
+        # Polling is started in the background, so that an unreachable Telegram Bot API (or an invalid token of one of
+        # several bots) does not prevent the start
+        threading.Thread(target=self.start_polling, name='start_polling', daemon=True).start()
+        logger.info("Bot {0!r} started in {1:.3f} s".format(self.config.name, self.startup_timer.total()),
+                    extra={'bot': self.config.name, 'phases': dict(self.startup_timer.phases)})
+        if self.owns_shared:
+            self.shared.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.updater.stop()
+        if self.owns_shared:
+            self.shared.stop()
+        self.updater.bot._msg_queue.stop()
+
+    def run(self):
+        """Starts the bot and blocks until it receives a stop signal."""
+        self.start()
+        wait_for_stop_signal()
+        self.stop()
+
+    def register_handlers(self, dispatcher: telegram.ext.Dispatcher):
         send_cancel_handler = CommandHandler('cancel', self.cancel_send)
 
         with warnings.catch_warnings():
@@ -662,13 +1223,24 @@ class TelegramShoutoutBot:
                     CommandHandler('admin', self.cmd_admin),
                     CommandHandler('register', self.cmd_register),
                     CommandHandler('unregister', self.cmd_unregister),
+                    CommandHandler('refresh', self.cmd_refresh),
                     CommandHandler('send', self.cmd_send),
                     CommandHandler('subscribe', self.cmd_subscribe),
-                    CommandHandler('unsubscribe', self.cmd_unsubscribe)
+                    CommandHandler('unsubscribe', self.cmd_unsubscribe),
+                    CommandHandler('status', self.cmd_status),
+                    CommandHandler('profile', self.cmd_profile),
+                    CommandHandler('backfill', self.cmd_backfill),
+                    CommandHandler('broadcasts', self.cmd_broadcasts),
+                    CommandHandler('edit', self.cmd_edit),
+                    CommandHandler('recall', self.cmd_recall)
                 ],
                 states={
                     SEND_CHANNEL: [CallbackQueryHandler(pattern=CB_CHANNEL_REGEX, callback=self.answer_channel),
+                                   CallbackQueryHandler(pattern=CB_PAGE_REGEX, callback=self.answer_keyboard_page),
+                                   CallbackQueryHandler(pattern=CB_SEND_CHANNELS_DONE,
+                                                        callback=self.answer_channels_done),
                                    CallbackQueryHandler(pattern=CB_SEND_CANCEL, callback=self.cancel_send),
+                                   CommandHandler('done', self.answer_channels_done),
                                    send_cancel_handler,
                                    MessageHandler(Filters.text, self.answer_channel)],
                     SEND_MESSAGE: [CallbackQueryHandler(pattern=CB_SEND_DONE, callback=self.answer_done),
@@ -682,12 +1254,16 @@ class TelegramShoutoutBot:
                                         send_cancel_handler],
                     SUBSCRIBE_CHANNEL: [CallbackQueryHandler(pattern=CB_CHANNEL_REGEX,
                                                              callback=self.answer_subscribe_channel),
+                                        CallbackQueryHandler(pattern=CB_PAGE_REGEX,
+                                                             callback=self.answer_keyboard_page),
                                         CallbackQueryHandler(pattern=CB_SUBSCRIBE_CANCEL,
                                                              callback=self.cancel_subscribe),
                                         CommandHandler('cancel', self.cancel_subscribe),
                                         MessageHandler(Filters.text, self.answer_subscribe_channel)],
                     UNSUBSCRIBE_CHANNEL: [CallbackQueryHandler(pattern=CB_CHANNEL_REGEX,
                                                                callback=self.answer_unsubscribe_channel),
+                                          CallbackQueryHandler(pattern=CB_PAGE_REGEX,
+                                                               callback=self.answer_keyboard_page),
                                           CallbackQueryHandler(pattern=CB_UNSUBSCRIBE_CANCEL,
                                                                callback=self.cancel_unsubscribe),
                                           CommandHandler('cancel', self.cancel_unsubscribe),
@@ -706,10 +1282,7 @@ class TelegramShoutoutBot:
         dispatcher.add_handler(fallback_msg_handler)
 
         # log all errors
-        dispatcher.add_error_handler(TelegramShoutoutBot.error)
-
-        updater.start_polling()
-        updater.idle()
+        dispatcher.add_error_handler(self.error)
 
 
 class MQBot(telegram.bot.Bot):
@@ -747,6 +1320,10 @@ class MQBot(telegram.bot.Bot):
     def send_photo(self, *args, **kwargs):
         return super(MQBot, self).send_photo(*args, **kwargs)
 
+    @mq.queuedmessage
+    def send_media_group(self, *args, **kwargs):
+        return super(MQBot, self).send_media_group(*args, **kwargs)
+
     @mq.queuedmessage
     def send_sticker(self, *args, **kwargs):
         return super(MQBot, self).send_sticker(*args, **kwargs)
@@ -755,10 +1332,60 @@ class MQBot(telegram.bot.Bot):
     def send_video(self, *args, **kwargs):
         return super(MQBot, self).send_video(*args, **kwargs)
 
+    @mq.queuedmessage
+    def edit_message_text(self, *args, **kwargs):
+        return super(MQBot, self).edit_message_text(*args, **kwargs)
+
+    @mq.queuedmessage
+    def edit_message_caption(self, *args, **kwargs):
+        return super(MQBot, self).edit_message_caption(*args, **kwargs)
+
+    @mq.queuedmessage
+    def delete_message(self, *args, **kwargs):
+        return super(MQBot, self).delete_message(*args, **kwargs)
+
     @mq.queuedmessage
     def edit_message_reply_markup(self, *args, **kwargs):
         return super(MQBot, self).edit_message_reply_markup(*args, **kwargs)
 
 
+def wait_for_stop_signal():
+    """Blocks until SIGINT, SIGTERM or SIGABRT is received.
+
+    Updater.idle() is not used, it exits the process immediately if its updater has not started polling yet.
+    """
+    stop_signal = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda signum, frame: stop_signal.set())
+    while not stop_signal.wait(1):
+        pass
+    logger.info("Received stop signal, stopping")
+
+
+def run_bots():
+    """Serves the main bot and all bots of Conf.bots and blocks until a stop signal is received."""
+    configs = tenants.get_bot_configs()
+    shared = SharedResources(bot_count=len(configs))
+    bots = []
+    for config in configs:
+        try:
+            bots.append(TelegramShoutoutBot(config=config, shared=shared))
+        except telegram.error.InvalidToken:
+            # The other bots are served anyway
+            logger.exception("Bot {0!r} has an invalid token and is not started".format(config.name),
+                             extra={'bot': config.name})
+    for bot in bots:
+        bot.start()
+    shared.start()
+    wait_for_stop_signal()
+    # Stop receiving updates of all bots before the workers, the message queues last
+    for bot in bots:
+        bot.stopping.set()
+        bot.updater.stop()
+    shared.stop()
+    for bot in bots:
+        bot.stop()
+
+
 if __name__ == '__main__':
-    bot = TelegramShoutoutBot()
+    run_bots()
@@ -0,0 +1,37 @@
+import os
+from typing import List
+
+from conf import Conf
+
+
+class BotConfig:
+    """Settings of one of the bots served by the process.
+
+    The main bot (name '') is configured by Conf itself, further bots by the entries of Conf.bots. Settings missing in
+    an entry are taken from Conf, the admin and user logs get the name of the bot as suffix.
+    """
+
+    def __init__(self, name: str = '', **settings):
+        self.name = name
+        self.bot_token = settings['bot_token'] if name != '' else Conf.bot_token
+        self.bot_api_url = settings.get('bot_api_url', Conf.bot_api_url)
+        self.bot_devs = settings.get('bot_devs', Conf.bot_devs)
+        self.url_impressum = settings.get('url_impressum', Conf.url_impressum)
+        self.admin_log = settings.get('admin_log', BotConfig.log_path(Conf.admin_log, name))
+        self.user_log = settings.get('user_log', BotConfig.log_path(Conf.user_log, name))
+
+    @staticmethod
+    def log_path(path: str, name: str) -> str:
+        if name == '':
+            return path
+        root, extension = os.path.splitext(path)
+        return "{0}.{1}{2}".format(root, name, extension)
+
+    def logger_name(self, kind: str) -> str:
+        if self.name == '':
+            return 'TelegramShoutoutBot.' + kind
+        return 'TelegramShoutoutBot.{0}.{1}'.format(self.name, kind)
+
+
+def get_bot_configs() -> List[BotConfig]:
+    return [BotConfig()] + [BotConfig(**settings) for settings in Conf.bots]
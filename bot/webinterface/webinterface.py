@@ -1,20 +1,19 @@
-from flask import Flask, g, request, render_template
-import logging
+import hmac
+
+from flask import Flask, g, request, render_template, jsonify, abort
 import db
 import ldap
+import log
+import readiness
 from conf import Conf
 
-# Log for web actions
-webLogger = logging.getLogger('TelegramShoutoutBot.web')
-webLogger.setLevel(logging.INFO)
-web_file_handler = logging.FileHandler(Conf.web_log)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-web_file_handler.setFormatter(formatter)
-webLogger.addHandler(web_file_handler)
+# Log for web actions. It is written by several gunicorn workers and rotated by logrotate (see docker/logrotate.conf)
+webLogger = log.create_logger('TelegramShoutoutBot.web', Conf.web_log, rotate=False)
 
 app = Flask(__name__)
 
-my_database = db.MyDatabase(Conf.database_url)
+# Both are initialized on first use, so that a slow database or LDAP server does not delay the worker startup
+my_database = db.MyDatabase(Conf.database_url, Conf.database_replica_url)
 ldap_access = ldap.LdapAccess(Conf.ldap_server, Conf.ldap_user,
                               Conf.ldap_password, Conf.ldap_base_group_filter)
 
@@ -30,6 +29,20 @@ def hello_world():
     return 'Hello, World!'
 
 
+@app.route('/ready')
+def ready():
+    # The database is needed for every request, so we check it here. LDAP is only reported as it is only needed for
+    # registrations.
+    try:
+        my_database.schema.ensure()
+    except Exception:
+        pass
+    dependencies = {dependency.name: dependency.report()
+                    for dependency in [my_database.schema, ldap_access.connection]}
+    status = 200 if my_database.schema.status == readiness.READY else 503
+    return jsonify(dependencies), status
+
+
 @app.route('/register/<chat_id>')
 def register(chat_id):
     token = request.args.get('token')
@@ -56,5 +69,24 @@ def register_login(chat_id):
         user.ldap_register_token = None
         session.commit()
         log_message_format = "Registered chat_id {0} with token {1} for LDAP-User {2}"
-        webLogger.info(log_message_format.format(chat_id, token, username))
+        webLogger.info(log_message_format.format(chat_id, token, username),
+                       extra={'chat_id': chat_id, 'ldap_account': ldap_account})
     return render_template('register_login_success.html', chat_id=chat_id, token=token, username=username)
+
+
+@app.route('/stats')
+def stats():
+    # The statistics contain the channels of all bots, they are only available with the configured token
+    if Conf.stats_token is None:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Stats-Token', ''), Conf.stats_token):
+        abort(403)
+    with db.my_session_scope(my_database) as session:  # type: db.MyDatabaseSession
+        channels = [{'name': channel.name,
+                     'description': channel.description,
+                     'default': channel.default,
+                     'mandatory': channel.mandatory,
+                     'subscribers': channel.subscriber_count,
+                     'bot': channel.bot}
+                    for channel in session.get_channels()]
+        return jsonify(users=session.count_users(), channels=channels)
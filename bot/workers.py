@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+from queue import Queue
+
+import log
+
+logger = log.get_logger(__name__)
+
+
+class QueueWaitMetrics:
+    """Collects how long tasks waited in the queue before a worker started them."""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, wait: float):
+        with self._lock:
+            self._recent.append(wait)
+            self.count += 1
+            self.total += wait
+            self.max = max(self.max, wait)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            recent = sorted(self._recent)
+            count = self.count
+            total = self.total
+            maximum = self.max
+
+        def percentile(p):
+            if len(recent) == 0:
+                return 0.0
+            return recent[min(len(recent) - 1, int(len(recent) * p))]
+
+        return {'count': count,
+                'mean': total / count if count > 0 else 0.0,
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'max': maximum}
+
+
+class ChatWorkerPool:
+    """Bounded thread pool that processes tasks of different chats concurrently, but the tasks of one chat one after
+    another in the order they were submitted.
+
+    submit() blocks if max_pending tasks are waiting or running, so that a flood of updates cannot grow the queue
+    without bound.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self._lock = threading.Lock()
+        # Tasks by chat; a chat is contained as long as one of its tasks is queued or running
+        self._chat_tasks = {}
+        # Chats that have a task which can be started
+        self._ready_chats = Queue()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self.wait_metrics = QueueWaitMetrics()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='chat_worker_{0}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        self._slots.acquire()
+        task = (time.monotonic(), func, args, kwargs)
+        with self._lock:
+            self._pending += 1
+            if chat_id in self._chat_tasks:
+                # The task is started by the worker that finishes the previous task of this chat
+                self._chat_tasks[chat_id].append(task)
+                return
+            self._chat_tasks[chat_id] = deque([task])
+        self._ready_chats.put(chat_id)
+
+    def stop(self):
+        for _ in self._threads:
+            self._ready_chats.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            chat_id = self._ready_chats.get()
+            if chat_id is _STOP:
+                return
+            with self._lock:
+                submitted, func, args, kwargs = self._chat_tasks[chat_id].popleft()
+            self.wait_metrics.record(time.monotonic() - submitted)
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Task for chat {0} failed".format(chat_id))
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    if len(self._chat_tasks[chat_id]) > 0:
+                        # Append the chat to the end of the queue so that other chats get their turn
+                        self._ready_chats.put(chat_id)
+                    else:
+                        del self._chat_tasks[chat_id]
+                self._slots.release()
+
+
+_STOP = object()
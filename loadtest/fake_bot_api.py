@@ -0,0 +1,179 @@
+"""A stand-in for the Telegram Bot API server.
+
+Updates are served from a queue filled by the load test script, every other call is recorded and answered with a
+plausible response. RetryAfter (HTTP 429) and timeout responses can be injected with configurable probabilities.
+"""
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Empty
+from urllib.parse import parse_qs
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Shoutout', 'username': 'shoutout_test_bot'}
+
+# Methods that are answered with a message object
+MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'sendSticker', 'sendVideo', 'editMessageText', 'editMessageCaption',
+                   'editMessageReplyMarkup'}
+
+
+class RecordedCall:
+    def __init__(self, method, params, timestamp, fault=None):
+        self.method = method
+        self.params = params
+        self.timestamp = timestamp
+        # The injected fault the call was answered with ('retry_after' or 'timeout'), None if it succeeded
+        self.fault = fault
+
+
+class FakeBotApi:
+    def __init__(self, host='127.0.0.1', port=0, retry_after_rate=0.0, retry_after_seconds=1,
+                 timeout_rate=0.0, timeout_seconds=6.0):
+        self.retry_after_rate = retry_after_rate
+        self.retry_after_seconds = retry_after_seconds
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.calls = []
+        self.calls_lock = threading.Lock()
+        self.injected = defaultdict(int)
+        # Listeners are called with every recorded call (from the request threads), including calls with faults
+        self.listeners = []
+        self._updates = Queue()
+        self._next_update_id = 1
+        self._next_message_id = defaultdict(lambda: 1000)
+        self._update_id_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{0}:{1}/bot'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake_bot_api', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update: dict) -> int:
+        """Makes an update available for getUpdates and returns its update_id."""
+        with self._update_id_lock:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+        update['update_id'] = update_id
+        self._updates.put(update)
+        return update_id
+
+    def calls_by_method(self) -> dict:
+        counts = defaultdict(int)
+        with self.calls_lock:
+            for call in self.calls:
+                if call.fault is None:
+                    counts[call.method] += 1
+        return dict(counts)
+
+    def _get_updates(self, params):
+        timeout = float(params.get('timeout', 0) or 0)
+        updates = []
+        try:
+            updates.append(self._updates.get(timeout=max(timeout, 0.01)))
+            while len(updates) < int(params.get('limit', 100) or 100):
+                updates.append(self._updates.get(block=False))
+        except Empty:
+            pass
+        return updates
+
+    def _message(self, method, params):
+        chat_id = int(params.get('chat_id'))
+        if 'message_id' in params:
+            message_id = int(params['message_id'])
+        else:
+            self._next_message_id[chat_id] += 1
+            message_id = self._next_message_id[chat_id]
+        message = {'message_id': message_id,
+                   'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': BOT_USER}
+        if 'text' in params:
+            message['text'] = params['text']
+        return message
+
+    def _answer(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        elif method == 'getUpdates':
+            return self._get_updates(params)
+        elif method in MESSAGE_METHODS:
+            return self._message(method, params)
+        elif method == 'sendMediaGroup':
+            media = params.get('media')
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [self._message(method, params) for _ in media]
+        return True
+
+    def _record(self, method, params, fault=None):
+        call = RecordedCall(method, params, time.monotonic(), fault)
+        with self.calls_lock:
+            self.calls.append(call)
+        for listener in self.listeners:
+            listener(call)
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                params = self._read_params()
+                if method not in ('getUpdates', 'getMe', 'deleteWebhook'):
+                    if random.random() < api.retry_after_rate:
+                        api.injected['retry_after'] += 1
+                        api._record(method, params, 'retry_after')
+                        self._respond(429, {'ok': False, 'error_code': 429,
+                                            'description': 'Too Many Requests: retry after {0}'
+                                            .format(api.retry_after_seconds),
+                                            'parameters': {'retry_after': api.retry_after_seconds}})
+                        return
+                    if random.random() < api.timeout_rate:
+                        api.injected['timeout'] += 1
+                        api._record(method, params, 'timeout')
+                        # The client gives up before we answer
+                        time.sleep(api.timeout_seconds)
+                        return
+                    api._record(method, params)
+                self._respond(200, {'ok': True, 'result': api._answer(method, params)})
+
+            do_GET = do_POST
+
+            def _read_params(self):
+                length = int(self.headers.get('Content-Length', 0) or 0)
+                body = self.rfile.read(length) if length > 0 else b''
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    return json.loads(body.decode('utf-8')) if body else {}
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+                return {}
+
+            def _respond(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
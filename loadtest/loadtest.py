@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+"""Load test for the bot without network access and without a real bot token.
+
+The bot runs against the fake Bot API server in fake_bot_api.py, LDAP uses the MOCK_SYNC strategy of ldap3 and the
+database is a temporary SQLite file. The script reports update-to-reply latencies and the broadcast throughput.
+
+Example:
+    python3 loadtest/loadtest.py --users 500 --channels 50 --retry-after-rate 0.01
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict, deque
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot')
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+ADMIN_CHAT_ID = 1
+ADMIN_DN = 'cn=admin,ou=People,dc=example,dc=com'
+SERVICE_DN = 'userid=telegram,ou=user,dc=example,dc=com'
+GROUP_DN = 'cn=telegram,ou=group,dc=example,dc=com'
+BROADCAST_TEXT = 'Load test broadcast'
+CONFIRMATION_TEXT = 'Bitte Versand bestätigen:'
+
+
+def create_conf(api: FakeBotApi, directory: str, args) -> types.ModuleType:
+    """Creates the conf module from conf.py.template, pointing everything to local resources."""
+    module = types.ModuleType('conf')
+    with open(os.path.join(BOT_DIR, 'conf.py.template')) as template:
+        exec(template.read(), module.__dict__)
+    conf = module.Conf
+    conf.bot_token = '123456:LOADTEST'
+    conf.bot_api_url = api.base_url
+    conf.database_url = 'sqlite:///' + os.path.join(directory, 'loadtest.sqlite')
+    conf.database_replica_url = None
+    conf.ldap_server = 'loadtest-ldap'
+    conf.ldap_user = SERVICE_DN
+    conf.ldap_password = 'secret'
+    conf.ldap_base_group_filter = '(&(objectclass=person)(memberOf={0}))'.format(GROUP_DN)
+    for log in ['error_log', 'admin_log', 'user_log', 'web_log']:
+        setattr(conf, log, os.path.join(directory, log + '.log'))
+    conf.bot_devs = []
+    conf.worker_threads = args.workers
+    return module
+
+
+def create_ldap_access(conf):
+    import ldap
+    from ldap3 import Connection, MOCK_SYNC
+    ldap_access = ldap.LdapAccess(conf.ldap_server, conf.ldap_user, conf.ldap_password, conf.ldap_base_group_filter,
+                                  client_strategy=MOCK_SYNC, credential_strategy=MOCK_SYNC)
+    # The entries of the mock directory are stored in the server object and shared by all its connections
+    connection = Connection(ldap_access.server, user=SERVICE_DN, password='secret', client_strategy=MOCK_SYNC)
+    connection.strategy.add_entry(SERVICE_DN, {'userPassword': 'secret', 'objectClass': 'inetOrgPerson'})
+    connection.strategy.add_entry(ADMIN_DN, {'userPassword': 'secret', 'objectClass': 'person',
+                                             'memberOf': GROUP_DN})
+    return ldap_access
+
+
+class LatencyTracker:
+    """Measures the time from making an update available until the first reply to its chat.
+
+    Replies answered with an injected fault are lost, they are counted as failed instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outstanding = defaultdict(deque)
+        self.latencies = defaultdict(list)
+        self.failed = defaultdict(int)
+
+    def update_sent(self, chat_id, phase):
+        with self._lock:
+            self._outstanding[chat_id].append((time.monotonic(), phase))
+
+    def on_call(self, call):
+        chat_id = call.params.get('chat_id')
+        if chat_id is None:
+            return
+        with self._lock:
+            outstanding = self._outstanding.get(int(chat_id))
+            if outstanding:
+                sent, phase = outstanding.popleft()
+                if call.fault is None:
+                    self.latencies[phase].append(call.timestamp - sent)
+                else:
+                    self.failed[phase] += 1
+
+    def outstanding(self) -> int:
+        with self._lock:
+            return sum(len(updates) for updates in self._outstanding.values())
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.outstanding() > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+def message_update(chat_id, text):
+    message_update.message_id += 1
+    message = {'message_id': message_update.message_id,
+               'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private', 'username': 'user{0}'.format(chat_id),
+                        'first_name': 'User', 'last_name': str(chat_id)},
+               'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+               'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+message_update.message_id = 0
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return 'no samples'
+    values = sorted(values)
+
+    def p(fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+    return 'n={0} p50={1:.1f} ms p90={2:.1f} ms p99={3:.1f} ms max={4:.1f} ms'\
+        .format(len(values), p(0.5), p(0.9), p(0.99), values[-1] * 1000)
+
+
+def send(api, tracker, chat_id, text, phase):
+    tracker.update_sent(chat_id, phase)
+    api.push_update(message_update(chat_id, text))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--broadcast-channels', type=int, default=3,
+                        help='number of channels the broadcast is sent to')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0,
+                        help='fraction of calls answered with 429 (RetryAfter)')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help='fraction of calls that are not answered before the client times out')
+    parser.add_argument('--timeout', type=float, default=300, help='maximum duration of each phase in seconds')
+    args = parser.parse_args()
+
+    api = FakeBotApi(retry_after_rate=args.retry_after_rate, timeout_rate=args.timeout_rate)
+    directory = tempfile.mkdtemp(prefix='shoutout-loadtest-')
+    sys.modules['conf'] = conf_module = create_conf(api, directory, args)
+    import db
+    from telegram_shoutout_bot import TelegramShoutoutBot
+
+    tracker = LatencyTracker()
+    api.listeners.append(tracker.on_call)
+    api.start()
+
+    bot = TelegramShoutoutBot(ldap_access=create_ldap_access(conf_module.Conf))
+    channel_names = ['channel{0}'.format(i) for i in range(args.channels)]
+    with db.my_session_scope(bot.my_database) as session:  # type: db.MyDatabaseSession
+        for i, name in enumerate(channel_names):
+            session.session.add(db.Channel(name=name, description='Load test channel {0}'.format(i),
+                                           default=(i == 0), ldap_filter='(objectClass=person)'))
+    bot.start()
+
+    try:
+        user_ids = list(range(ADMIN_CHAT_ID, ADMIN_CHAT_ID + args.users))
+        print("Phase 1: /start for {0} users".format(len(user_ids)))
+        for chat_id in user_ids:
+            send(api, tracker, chat_id, '/start', 'start')
+        tracker.wait(args.timeout)
+
+        print("Phase 2: /help, /subscribe and channel selection")
+        for chat_id in user_ids:
+            send(api, tracker, chat_id, '/help', 'help')
+            send(api, tracker, chat_id, '/subscribe', 'subscribe')
+            send(api, tracker, chat_id, channel_names[chat_id % len(channel_names)], 'subscribe_channel')
+        tracker.wait(args.timeout)
+
+        print("Phase 3: broadcast")
+        with db.my_session_scope(bot.my_database) as session:  # type: db.MyDatabaseSession
+            session.get_user_by_chat_id(ADMIN_CHAT_ID).ldap_account = ADMIN_DN
+        target_channels = channel_names[:args.broadcast_channels]
+        with db.my_session_scope(bot.my_database) as session:  # type: db.MyDatabaseSession
+            channel_ids = [channel.id for channel in session.get_channels_by_names(target_channels)]
+            expected = len(set(session.get_subscriber_chat_ids(channel_ids)))
+        confirmation_requested = threading.Event()
+        api.listeners.append(lambda call: confirmation_requested.set()
+                             if call.fault is None and call.params.get('text') == CONFIRMATION_TEXT else None)
+        for text in ['/send', ', '.join(target_channels), '/done', BROADCAST_TEXT, '/done']:
+            send(api, tracker, ADMIN_CHAT_ID, text, 'send_conversation')
+            tracker.wait(args.timeout)
+        # The preview of the broadcast is sent to the admin before the confirmation request, so it is not counted
+        confirmation_requested.wait(args.timeout)
+
+        delivered = []
+        api.listeners.append(lambda call: delivered.append(call.timestamp)
+                             if call.fault is None and call.method == 'sendMessage'
+                             and call.params.get('text') == BROADCAST_TEXT else None)
+        start = time.monotonic()
+        send(api, tracker, ADMIN_CHAT_ID, '/confirm', 'confirm')
+        deadline = start + args.timeout
+        while len(delivered) < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        duration = (delivered[-1] if delivered else time.monotonic()) - start
+
+        print()
+        print("Update-to-reply latency:")
+        for phase, latencies in tracker.latencies.items():
+            failed = " ({0} replies failed)".format(tracker.failed[phase]) if tracker.failed[phase] > 0 else ""
+            print("  {0:<20} {1}{2}".format(phase, percentiles(latencies), failed))
+        print("Broadcast: {0}/{1} messages delivered in {2:.2f} s ({3:.1f} messages/s)"
+              .format(len(delivered), expected, duration, len(delivered) / duration if duration > 0 else 0))
+        print("Calls by method: {0}".format(api.calls_by_method()))
+        print("Injected faults: {0}".format(dict(api.injected)))
+        print("Logs and database: {0}".format(directory))
+    finally:
+        bot.stop()
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
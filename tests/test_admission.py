@@ -0,0 +1,84 @@
+"""Unit tests of bot/admission.py, run with: python -m unittest discover tests"""
+import os
+import sys
+import threading
+import types
+import unittest
+
+from telegram.error import RetryAfter
+from telegram.utils.promise import Promise
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bot')
+sys.path.insert(0, BOT_DIR)
+if 'conf' not in sys.modules:
+    # admission imports log, which needs the configuration
+    conf_module = types.ModuleType('conf')
+    with open(os.path.join(BOT_DIR, 'conf.py.template')) as template:
+        exec(template.read(), conf_module.__dict__)
+    sys.modules['conf'] = conf_module
+
+import admission  # noqa: E402
+
+
+def finished_promise(result=None, exception=None) -> Promise:
+    def send():
+        if exception is not None:
+            raise exception
+        return result
+
+    promise = Promise(send, (), {})
+    promise.run()
+    return promise
+
+
+class SendWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.done = []
+        self.window = admission.SendWindow(admission.BroadcastAdmission(max_concurrent=1, max_queued_messages=1))
+        self.window.on_done = lambda key, promises: self.done.append((key, promises))
+
+    def test_failed_promise_does_not_stop_the_window(self):
+        failed = finished_promise(exception=RetryAfter(1))
+        self.window.add(1, [finished_promise(result='message')])
+        self.window.add(2, [failed])
+        self.window.add(3, [finished_promise(result='message')])
+        self.window.finish()
+
+        self.assertEqual([1, 2, 3], [key for key, _ in self.done])
+        self.assertIsInstance(self.done[1][1][0].exception, RetryAfter)
+
+    def test_add_waits_for_unfinished_promises(self):
+        promise = Promise(lambda: 'message', (), {})
+        threading.Timer(0.1, promise.run).start()
+        # The share is one message, so add() waits for the promise
+        self.window.add(1, [promise])
+
+        self.assertEqual([(1, [promise])], self.done)
+        self.assertEqual('message', promise.result())
+
+
+class BroadcastAdmissionTest(unittest.TestCase):
+
+    def test_broadcast_with_failed_sends_completes(self):
+        broadcast_admission = admission.BroadcastAdmission(max_concurrent=1, max_queued_messages=2)
+        completed = threading.Event()
+        recorded = []
+        errors = []
+
+        def broadcast(window):
+            window.on_done = lambda key, promises: recorded.append(key)
+            for chat_id in range(10):
+                exception = RetryAfter(1) if chat_id % 3 == 0 else None
+                window.add(chat_id, [finished_promise(result='message', exception=exception)])
+            window.finish()
+            completed.set()
+
+        broadcast_admission.submit(broadcast, on_error=errors.append)
+        self.assertTrue(completed.wait(5))
+        self.assertEqual(list(range(10)), recorded)
+        self.assertEqual([], errors)
+
+
+if __name__ == '__main__':
+    unittest.main()